@@ -4,17 +4,273 @@ Camera Manager для Raspberry Pi Camera Module 3
 Использует picamera2 для dual-stream захвата с аппаратным H.264 кодированием
 """
 
+import collections
+import ctypes
+import fcntl
+import io
 import logging
+import mmap
 import subprocess
 import os
-from picamera2 import Picamera2
+import shutil
+import threading
+from urllib.parse import quote, urlsplit, urlunsplit
+import numpy as np
+from picamera2 import MappedArray, Picamera2
 from picamera2.encoders import H264Encoder, Quality
-from picamera2.outputs import CircularOutput, FileOutput, FfmpegOutput
+from picamera2.outputs import FileOutput, Output
 from libcamera import Transform, controls
 import time
 
 logger = logging.getLogger(__name__)
 
+# fcntl.F_SETPIPE_SZ появился только в Python 3.10
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
+# fallocate(2) с FALLOC_FL_KEEP_SIZE: os.posix_fallocate флагов не принимает
+FALLOC_FL_KEEP_SIZE = 0x01
+_libc = ctypes.CDLL(None, use_errno=True)
+_fallocate = getattr(_libc, 'fallocate64', None) or getattr(_libc, 'fallocate', None)
+if _fallocate is not None:
+    _fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    _fallocate.restype = ctypes.c_int
+
+
+def _preallocate_keep_size(fd: int, length: int):
+    """Выделить блоки под файл, не меняя его видимый размер
+
+    st_size растёт только по мере записи: учёт места в RecordingManager
+    видит реальный объём, а файл, брошенный при сбое, не содержит нулевого
+    хвоста (лишние блоки за концом файла освобождает ftruncate/удаление).
+    """
+    if _fallocate is None:
+        raise OSError("fallocate недоступен")
+    if _fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, length) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def _inject_auth(url: str, username: str, password: str) -> str:
+    """Добавить логин/пароль в URL (с экранированием '@', ':' и '/')"""
+    parts = urlsplit(url)
+    if not parts.scheme:
+        return url
+
+    host = parts.netloc.rsplit('@', 1)[-1]
+    netloc = f"{quote(username, safe='')}:{quote(password, safe='')}@{host}"
+    return urlunsplit(parts._replace(netloc=netloc))
+
+
+class RingPipeWriter(io.RawIOBase):
+    """
+    Запись в pipe без блокировки callback'а encoder
+
+    Кадры копятся в ограниченной очереди и сливаются в pipe фоновым потоком.
+    Если читатель (ffmpeg) не успевает, самые старые кадры отбрасываются.
+    """
+
+    def __init__(self, pipe, maxlen: int):
+        super().__init__()
+        self._pipe = pipe
+        self._frames = collections.deque(maxlen=maxlen)
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        # Буфер encoder переиспользуется, поэтому кадр копируется
+        with self._cond:
+            self._frames.append(bytes(data))
+            self._cond.notify()
+        return len(data)
+
+    def set_pipe(self, pipe):
+        """Переключиться на новый pipe (после перезапуска ffmpeg)"""
+        with self._cond:
+            self._pipe = pipe
+            self._frames.clear()
+
+    def close(self):
+        with self._cond:
+            super().close()
+            self._cond.notify()
+
+    def _drain(self):
+        """Фоновый поток: перенос кадров из очереди в pipe"""
+        while True:
+            with self._cond:
+                while not self._frames and not self.closed:
+                    self._cond.wait()
+                if self.closed:
+                    return
+                # Всё накопленное уходит одним writev вместо write на каждый кадр
+                pending = [memoryview(frame) for frame in self._frames]
+                self._frames.clear()
+                pipe = self._pipe
+
+            try:
+                fd = pipe.fileno()
+                while pending:
+                    written = os.writev(fd, pending)
+                    while pending and written >= len(pending[0]):
+                        written -= len(pending.pop(0))
+                    if written:
+                        pending[0] = pending[0][written:]
+            except (OSError, ValueError):
+                # ffmpeg завершился - кадры теряются до перезапуска watchdog'ом
+                pass
+
+
+class ShmCircularOutput(Output):
+    """
+    Циркулярный буфер предзаписи в /dev/shm
+
+    Замена CircularOutput с тем же порядком работы (fileoutput = ..., start(), stop()).
+    Байты кадров хранятся в mmap на tmpfs - вне кучи Python и вне GC,
+    в Python остаётся только индекс кадров (смещение, длина, ключевой кадр).
+    При старте записи предзапись отдаётся в fileoutput фоновым потоком,
+    чтобы callback encoder не ждал, пока ffmpeg вычитает pipe.
+    Файл не удаляется при закрытии: после сбоя предзапись можно изучить.
+    """
+
+    def __init__(self, size: int, path: str = '/dev/shm/rascam_ring'):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._size = size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        os.ftruncate(self._fd, size)
+        self._mm = mmap.mmap(self._fd, size)
+        self._index = collections.deque()
+        self._pos = 0
+        self._fileoutput = None
+        self._writing = False
+
+        # Предзапись сливается отдельным потоком: пока он пишет, новые кадры
+        # копятся в _pending и дописываются следом (порядок кадров сохраняется)
+        self._draining = False
+        self._pending = collections.deque()
+        self._drain_thread = None
+
+    @property
+    def fileoutput(self):
+        return self._fileoutput
+
+    @fileoutput.setter
+    def fileoutput(self, file):
+        self._fileoutput = file
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        with self._lock:
+            if self._writing:
+                if self._draining:
+                    # Буфер encoder переиспользуется - кадр копируется
+                    self._pending.append(bytes(frame))
+                else:
+                    self._write(frame)
+            self._append(frame, keyframe)
+
+    def _append(self, frame, keyframe):
+        """Записать кадр в кольцо, вытеснив перекрытые им старые кадры"""
+        length = len(frame)
+        if length > self._size:
+            return
+
+        if self._pos + length > self._size:
+            # Кадр не делится: переход в начало, хвост прошлого круга устарел
+            while self._index and self._index[0][0] >= self._pos:
+                self._index.popleft()
+            self._pos = 0
+
+        end = self._pos + length
+        while self._index and self._pos <= self._index[0][0] < end:
+            self._index.popleft()
+
+        self._mm[self._pos:end] = frame
+        self._index.append((self._pos, length, keyframe))
+        self._pos = end
+
+    def _write(self, frame):
+        try:
+            self._fileoutput.write(frame)
+        except (OSError, ValueError) as e:
+            logger.error(f"Ошибка записи кадра: {e}")
+            self._writing = False
+
+    def start(self):
+        """Начать запись в fileoutput, начиная с самого старого ключевого кадра"""
+        with self._lock:
+            if self._fileoutput is None or self._writing:
+                # Вызов от encoder при его запуске - только буферизация
+                return
+
+            while self._index and not self._index[0][2]:
+                self._index.popleft()
+
+            # Под замком - только копия предзаписи из mmap (memcpy, без I/O):
+            # кольцо продолжает перезаписываться, а запись в pipe может ждать
+            # ffmpeg секундами и не должна держать callback encoder
+            chunks = [self._mm[offset:offset + length] for offset, length, _ in self._index]
+            self._index.clear()
+            self._pending.clear()
+            self._writing = True
+            self._draining = True
+            self._drain_thread = threading.Thread(
+                target=self._drain_preroll, args=(self._fileoutput, chunks),
+                name="preroll", daemon=True)
+            self._drain_thread.start()
+
+    def _drain_preroll(self, fileoutput, chunks):
+        """Фоновый поток: записать предзапись, затем кадры, пришедшие за это время"""
+        while True:
+            try:
+                for chunk in chunks:
+                    fileoutput.write(chunk)
+            except (OSError, ValueError) as e:
+                logger.error(f"Ошибка записи предзаписи: {e}")
+                with self._lock:
+                    self._writing = False
+                    self._draining = False
+                    self._pending.clear()
+                return
+
+            with self._lock:
+                if not self._draining:
+                    # stop() во время слива
+                    return
+                if not self._pending:
+                    # Догнали encoder - дальше кадры пишутся прямо из outputframe
+                    self._draining = False
+                    return
+                chunks = list(self._pending)
+                self._pending.clear()
+
+    def stop(self):
+        """Закончить запись и закрыть fileoutput"""
+        with self._lock:
+            if not self._writing:
+                return
+            self._writing = False
+            self._draining = False
+            self._pending.clear()
+            fileoutput, self._fileoutput = self._fileoutput, None
+            drain_thread, self._drain_thread = self._drain_thread, None
+
+        # Дождаться потока слива вне замка (он берёт замок в конце каждого шага)
+        if drain_thread is not None:
+            drain_thread.join(timeout=5.0)
+        try:
+            fileoutput.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """Освободить mmap (файл в /dev/shm остаётся)"""
+        self._mm.close()
+        os.close(self._fd)
+
 
 class CameraManager:
     def __init__(self, config):
@@ -26,6 +282,36 @@ class CameraManager:
         self.current_file = None
         self.rtsp_output = None
         self.ffmpeg_process = None
+        self.mux_process = None
+        self._rtsp_cmd = None
+        self._rtsp_watchdog = None
+        self._rtsp_watchdog_stop = threading.Event()
+        self.ffmpeg_log = collections.deque(maxlen=500)
+        self._rtsp_writer = None
+        self._gop_frames = config['camera']['framerate']
+
+        # Абсолютный путь к ffmpeg: вместе с close_fds=False позволяет CPython
+        # запускать процесс через posix_spawn (vfork) без копирования памяти
+        self._ffmpeg_bin = shutil.which('ffmpeg') or 'ffmpeg'
+
+        # Неизменяемые параметры конфигурации, разобранные один раз
+        self._main_res = tuple(config['camera']['main_resolution'])
+        self._lores_res = tuple(config['camera']['lores_resolution'])
+        self._framerate = config['camera']['framerate']
+        self._expected_segment_bytes = int(
+            config['video']['bitrate'] / 8 * config['recording']['segment_duration']
+        )
+        self._record_fd = None
+        self._latest_lores = (None, None)
+        self._frame_event = threading.Event()
+        # Буфер ждущего get_lores_frame(out=...): callback копирует кадр прямо
+        # в него. Замок защищает передачу буфера и саму копию
+        self._lores_target = None
+        self._lores_lock = threading.Lock()
+        self._camera_running = False
+        self._encoder_running = False
+        self._fps_ctrl = {"FrameRate": float(self._framerate)}
+        self._rtsp_url, self._rtsp_url_with_auth = self._build_rtsp_url()
 
     def initialize(self):
         """Инициализация камеры с dual-stream конфигурацией"""
@@ -58,45 +344,92 @@ class CameraManager:
                 transpose=transpose
             )
 
+            # Буферы main потока занимают CMA; для ISP -> encoder -> буфер хватает 4
+            buffer_count = self.config['camera'].get('buffer_count', 4)
+            cma_mb = self._main_res[0] * self._main_res[1] * 1.5 * buffer_count / 1e6
+            logger.info(f"Буферов main потока: {buffer_count} (CMA ~{cma_mb:.1f} MB)")
+            self._check_cma_headroom(cma_mb)
+
             # Dual stream: main для записи, lores для детекции движения
             video_config = self.picam2.create_video_configuration(
                 main={
-                    "size": tuple(self.config['camera']['main_resolution']),
+                    "size": self._main_res,
                     "format": "YUV420"
                 },
                 lores={
-                    "size": tuple(self.config['camera']['lores_resolution']),
+                    "size": self._lores_res,
                     "format": "YUV420"
                 },
                 transform=transform,
                 encode="main",
-                buffer_count=6
+                buffer_count=buffer_count
             )
 
             self.picam2.configure(video_config)
 
+            # Геометрия Y-плоскости lores (stride может быть выровнен больше ширины)
+            self._lores_w, self._lores_h = self._lores_res
+            self._lores_stride = self.picam2.stream_configuration('lores')['stride']
+
+            # Кольцо из 3 постоянных буферов Y-плоскости: post_callback копирует
+            # в них кадр прямо из DMA-буфера, без make_buffer (аллокация + копия YUV),
+            # если никто не ждёт кадр со своим буфером (get_lores_frame(out=...))
+            self._lores_slots = [
+                np.empty((self._lores_h, self._lores_w), dtype=np.uint8) for _ in range(3)
+            ]
+            self._lores_slot = 0
+
             # Включить постоянный автофокус для Camera Module 3
             self.picam2.set_controls({
                 "AfMode": controls.AfModeEnum.Continuous,
                 "AfSpeed": controls.AfSpeedEnum.Fast
             })
 
-            # Настройка H.264 энкодера (аппаратное ускорение через GPU)
+            # Известный период IDR: предзапись всегда начинается с ключевого кадра
+            framerate = self._framerate
+            gop_frames = self.config['video'].get('keyframe_interval', framerate)
+            self._gop_frames = gop_frames
+
+            # Настройка H.264 энкодера (аппаратное ускорение через GPU).
+            # repeat=True повторяет SPS/PPS перед каждым IDR: RTSP клиент,
+            # подключившийся посреди потока, стартует с ближайшего ключевого кадра
             bitrate = self.config['video']['bitrate']
-            self.encoder = H264Encoder(bitrate=bitrate)
+            self.encoder = H264Encoder(bitrate=bitrate, repeat=True, iperiod=gop_frames)
 
-            # Циркулярный буфер для предзаписи
+            # Циркулярный буфер для предзаписи в /dev/shm: +1 GOP, чтобы после
+            # отсечения до IDR осталось pre_record_seconds; x2 - запас на IDR кадры
             pre_record_seconds = self.config['recording']['pre_record_seconds']
-            buffer_size = int((bitrate * pre_record_seconds) / 8)
-            self.circular_output = CircularOutput(buffersize=buffer_size)
+            buffer_frames = int(framerate * pre_record_seconds) + gop_frames
+            buffer_size = int(buffer_frames * bitrate / framerate / 8) * 2
+            self.circular_output = ShmCircularOutput(buffer_size)
+
+            # RTSP и запись работают от одного encoder: ffmpeg для MediaMTX
+            # запускается один раз, в start() поток подключается вторым выводом
+            if self.config.get('streaming', {}).get('enabled', False):
+                self.start_streaming()
 
-            logger.info(f"Камера настроена: {self.config['camera']['main_resolution']} @ {self.config['camera']['framerate']}fps")
-            logger.info(f"Циркулярный буфер: {pre_record_seconds}s ({buffer_size / 1024 / 1024:.1f} MB)")
+            logger.info(f"Камера настроена: {list(self._main_res)} @ {self._framerate}fps")
+            logger.info(f"Циркулярный буфер: {pre_record_seconds}s + GOP {gop_frames} кадров "
+                        f"({buffer_size / 1024 / 1024:.1f} MB в /dev/shm)")
 
         except Exception as e:
             logger.error(f"Ошибка инициализации камеры: {e}")
             raise
 
+    def _check_cma_headroom(self, required_mb):
+        """Предупредить, если свободной CMA памяти меньше, чем нужно буферам"""
+        try:
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    if line.startswith('CmaFree:'):
+                        free_mb = int(line.split()[1]) / 1024
+                        if free_mb < required_mb:
+                            logger.warning(f"Мало CMA памяти: свободно {free_mb:.1f} MB, "
+                                           f"нужно ~{required_mb:.1f} MB")
+                        return
+        except OSError:
+            pass
+
     def start(self):
         """Запуск захвата видео"""
         try:
@@ -105,55 +438,157 @@ class CameraManager:
 
             logger.info("Запуск камеры...")
             self.picam2.start()
-            time.sleep(2)  # Дать время на автонастройку экспозиции/баланса белого
+            self._camera_running = True
+
+            # Encoder запускается только после сходимости AE/AWB, чтобы
+            # циркулярный буфер не заполнялся пересвеченными кадрами
+            self._wait_for_convergence()
+
+            # Кадры lores доставляются libcamera в callback, без опроса из Python
+            self.picam2.post_callback = self._on_frame
 
-            # Запуск энкодера с циркулярным буфером
-            self.encoder.output = self.circular_output
+            # Запуск энкодера с циркулярным буфером (и RTSP, если поток уже создан).
+            # Encoder работает постоянно, запись лишь переключает вывод буфера в файл
+            outputs = [self.circular_output]
+            if self.rtsp_output:
+                outputs.append(self.rtsp_output)
+            self.encoder.output = outputs
             self.picam2.start_encoder(self.encoder)
+            self._encoder_running = True
 
             logger.info("Камера запущена, захват видео активен")
 
-            # RTSP стриминг временно отключен
-            # TODO: Реализовать стабильный RTSP через два отдельных encoder
-            # if self.config.get('streaming', {}).get('enabled', False):
-            #     self.start_streaming()
-
         except Exception as e:
             logger.error(f"Ошибка запуска камеры: {e}")
             raise
 
-    def get_lores_frame(self):
-        """Получить кадр низкого разрешения для детекции движения"""
-        try:
+    def _wait_for_convergence(self, timeout=1.0):
+        """Дождаться автонастройки экспозиции и баланса белого (не дольше timeout)"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
             metadata = self.picam2.capture_metadata()
-            frame = self.picam2.capture_buffer("lores")
-            return frame, metadata
+            if metadata.get('AeLocked') and metadata.get('AwbLocked'):
+                logger.info("AE/AWB сошлись")
+                return True
+            time.sleep(0.05)
+
+        logger.info(f"AE/AWB не сошлись за {timeout}s, продолжение запуска")
+        return False
+
+    def _on_frame(self, request):
+        """post_callback picamera2: опубликовать Y-плоскость lores нового кадра"""
+        try:
+            h, stride = self._lores_h, self._lores_stride
+            metadata = request.get_metadata()
+
+            with self._lores_lock:
+                # Ждущий читатель получает кадр сразу в свой буфер; иначе кадр
+                # ложится в следующий постоянный слот
+                frame, self._lores_target = self._lores_target, None
+                if frame is None:
+                    frame = self._lores_slots[self._lores_slot]
+                    self._lores_slot = (self._lores_slot + 1) % len(self._lores_slots)
+
+                # View на буфер libcamera действителен только внутри callback -
+                # Y-плоскость копируется из него один раз
+                with MappedArray(request, "lores", write=False) as mapped:
+                    y_plane = mapped.array.reshape(-1)[:h * stride].reshape((h, stride))
+                    np.copyto(frame, y_plane[:, :self._lores_w])
+
+                # Одно присваивание кортежа - читатель всегда видит согласованную пару
+                self._latest_lores = (frame, metadata)
+                self._frame_event.set()
         except Exception as e:
-            logger.error(f"Ошибка захвата lores кадра: {e}")
-            return None, None
+            logger.error(f"Ошибка обработки lores кадра: {e}")
+
+    def get_lores_frame(self, timeout=1.0, out=None):
+        """
+        Получить кадр низкого разрешения для детекции движения
+
+        Блокируется до появления нового кадра (не дольше timeout).
+
+        Args:
+            timeout: максимальное ожидание кадра, сек
+            out: заранее выделенный uint8 буфер (h, w). Если нового кадра ещё
+                нет, callback копирует Y-канал прямо в out (одна копия из DMA);
+                если кадр уже пришёл в постоянный буфер - он копируется в out
+
+        Returns:
+            (y_plane, metadata) где y_plane - out, либо один из постоянных буферов
+            камеры (перезаписывается через 3 кадра)
+        """
+        if out is not None:
+            with self._lores_lock:
+                if not self._frame_event.is_set():
+                    self._lores_target = out
+
+        if not self._frame_event.wait(timeout):
+            # Забрать буфер обратно; замок дожидается копии, если callback
+            # уже начал писать в out
+            with self._lores_lock:
+                self._lores_target = None
+                if not self._frame_event.is_set():
+                    return None, None
+        self._frame_event.clear()
+
+        frame, metadata = self._latest_lores
+        if out is not None and frame is not out:
+            np.copyto(out, frame)
+            return out, metadata
+        return frame, metadata
 
     def start_recording(self, filename):
-        """Начать запись в файл"""
+        """Начать запись в файл (с предзаписью из циркулярного буфера)"""
         try:
             logger.info(f"Начало записи: {filename}")
 
-            # Создаём FfmpegOutput для записи в файл
-            file_output = FfmpegOutput(filename)
-            self.current_output = file_output
+            # Файл выделяется одним экстентом на весь сегмент заранее:
+            # на SD/USB нет дробного роста файла и связанных с ним задержек
+            self._record_fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                _preallocate_keep_size(self._record_fd, self._expected_segment_bytes)
+            except OSError as e:
+                logger.debug(f"fallocate недоступен: {e}")
+            os.posix_fadvise(self._record_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+            # ffmpeg только упаковывает готовый H.264 поток в MP4, без перекодирования
+            # Фрагментированный MP4 читается даже если запись оборвалась
+            mux_cmd = [
+                self._ffmpeg_bin,
+                '-fflags', '+genpts',
+                '-f', 'h264',
+                '-framerate', str(self._framerate),
+                '-i', 'pipe:0',
+                '-c:v', 'copy',
+                '-f', 'mp4',
+                '-movflags', '+frag_keyframe+empty_moov',
+                'pipe:1'
+            ]
+            # Фрагментированный MP4 не требует seek, ffmpeg пишет в наш fd
+            self.mux_process = subprocess.Popen(
+                mux_cmd,
+                stdin=subprocess.PIPE,
+                stdout=self._record_fd,
+                stderr=subprocess.DEVNULL,
+                close_fds=False
+            )
 
-            # Остановить encoder и переключить на file output
-            self.picam2.stop_encoder()
-            self.encoder.output = file_output
-            self.picam2.start_encoder(self.encoder)
+            # Encoder не перезапускается: циркулярный буфер сбрасывает предзапись
+            # в muxer и продолжает писать туда новые кадры
+            self.circular_output.fileoutput = self.mux_process.stdin
+            self.circular_output.start()
+            self.current_output = self.mux_process
+            self._request_key_frame()
 
-            # RTSP поток прервётся, но это нормально для записи
-            # После окончания записи - восстановим RTSP
-            logger.info("Запись начата, RTSP временно приостановлен")
+            logger.info("Запись начата")
 
             return True
 
         except Exception as e:
             logger.error(f"Ошибка начала записи: {e}")
+            if self._record_fd is not None:
+                os.close(self._record_fd)
+                self._record_fd = None
             return False
 
     def stop_recording(self):
@@ -162,13 +597,10 @@ class CameraManager:
             if self.current_output:
                 logger.info("Остановка записи")
 
-                # Остановить энкодер
-                self.picam2.stop_encoder()
+                # Циркулярный буфер дописывает остаток и закрывает pipe в muxer
+                self.circular_output.stop()
                 self.current_output = None
-
-                # Вернуться к circular buffer
-                self.encoder.output = self.circular_output
-                self.picam2.start_encoder(self.encoder)
+                self._close_muxer()
 
                 return True
             return False
@@ -177,72 +609,90 @@ class CameraManager:
             logger.error(f"Ошибка остановки записи: {e}")
             return False
 
+    def _close_muxer(self):
+        """Дождаться завершения ffmpeg, упаковывающего текущую запись"""
+        if self.mux_process is None:
+            return
+
+        try:
+            if not self.mux_process.stdin.closed:
+                self.mux_process.stdin.close()
+            self.mux_process.wait(timeout=10)
+        except Exception as e:
+            logger.warning(f"Ошибка при завершении ffmpeg записи: {e}")
+            try:
+                self.mux_process.kill()
+            except:
+                pass
+        self.mux_process = None
+
+        if self._record_fd is not None:
+            try:
+                # ffmpeg делил с нами позицию файла: ftruncate по ней освобождает
+                # предвыделенные блоки за концом файла; записанные данные
+                # убираются из page cache. DONTNEED пропускает грязные страницы,
+                # поэтому сначала fdatasync - иначе подсказка почти ничего не даёт
+                size = os.lseek(self._record_fd, 0, os.SEEK_CUR)
+                os.ftruncate(self._record_fd, size)
+                os.fdatasync(self._record_fd)
+                os.posix_fadvise(self._record_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            except OSError as e:
+                logger.warning(f"Ошибка завершения файла записи: {e}")
+            finally:
+                os.close(self._record_fd)
+                self._record_fd = None
+
     def is_recording(self):
         """Проверка, идёт ли сейчас запись"""
         return self.current_output is not None
 
     def start_streaming(self):
-        """Запуск RTSP стриминга в MediaMTX"""
+        """Запуск RTSP стриминга в MediaMTX (один долгоживущий ffmpeg процесс)"""
         try:
             streaming_config = self.config.get('streaming', {})
             if not streaming_config.get('enabled', False):
                 return False
 
-            from picamera2.outputs import FfmpegOutput
-
-            # RTSP URL для MediaMTX
-            rtsp_url = streaming_config.get('mediamtx_url', 'rtsp://localhost:8554/cam1')
-            username = streaming_config.get('username', 'admin')
-            password = streaming_config.get('password', 'changeme')
-
-            # Формируем URL с авторизацией
-            if '://' in rtsp_url:
-                protocol, rest = rtsp_url.split('://', 1)
-                rtsp_url_with_auth = f"{protocol}://{username}:{password}@{rest}"
-            else:
-                rtsp_url_with_auth = rtsp_url
-
-            logger.info(f"Запуск RTSP стриминга в MediaMTX: {rtsp_url}")
+            # В лог - URL без пароля; ffmpeg публикует с логином/паролем
+            # (publishUser/publishPass в mediamtx.yml)
+            logger.info(f"Запуск RTSP стриминга в MediaMTX: {self._rtsp_url}")
 
             # Запускаем отдельный процесс ffmpeg который будет читать из stdin
             # и пушить в MediaMTX через RTSP
-            # Временно без авторизации для отладки
-            ffmpeg_cmd = [
-                'ffmpeg',
+            self._rtsp_cmd = [
+                self._ffmpeg_bin,
                 '-f', 'h264',  # Входной формат
                 '-use_wallclock_as_timestamps', '1',  # Использовать системное время
+                '-fflags', 'nobuffer',  # Без входной буферизации
+                '-flags', 'low_delay',
+                '-probesize', '32',  # Поток известен, долгий анализ не нужен
+                '-analyzeduration', '0',
                 '-i', 'pipe:0',  # Читать из stdin
                 '-c:v', 'copy',  # Не перекодировать
+                '-flush_packets', '1',  # Отправлять пакеты сразу, без буферизации
                 '-f', 'rtsp',  # Выходной формат
                 '-rtsp_transport', 'tcp',  # Использовать TCP
-                rtsp_url  # Без credentials для теста
+                self._rtsp_url_with_auth
             ]
 
             try:
-                # Временно логируем stderr для отладки
-                stderr_log = open('/tmp/ffmpeg_rtsp.log', 'w')
-
-                self.ffmpeg_process = subprocess.Popen(
-                    ffmpeg_cmd,
-                    stdin=subprocess.PIPE,
-                    stdout=subprocess.DEVNULL,
-                    stderr=stderr_log
-                )
+                self._spawn_rtsp_process()
 
-                # Создаём FileOutput который пишет в stdin ffmpeg
-                from picamera2.outputs import FileOutput
-                self.rtsp_output = FileOutput(self.ffmpeg_process.stdin)
-
-                logger.info(f"FFmpeg процесс запущен (PID: {self.ffmpeg_process.pid})")
+                # FileOutput пишет в stdin ffmpeg через очередь на один GOP,
+                # чтобы задержки RTSP по TCP не блокировали encoder
+                self._rtsp_writer = RingPipeWriter(self.ffmpeg_process.stdin, self._gop_frames)
+                self.rtsp_output = FileOutput(self._rtsp_writer)
             except Exception as e:
                 logger.error(f"Ошибка запуска ffmpeg: {e}")
                 return False
 
-            # Переключаем encoder на RTSP output
-            self.picam2.stop_encoder()
-            self.encoder.output = self.rtsp_output
-            self.picam2.start_encoder(self.encoder)
+            # Watchdog перезапускает упавший ffmpeg, не трогая encoder
+            self._rtsp_watchdog_stop.clear()
+            self._rtsp_watchdog = threading.Thread(target=self._rtsp_watchdog_loop, daemon=True)
+            self._rtsp_watchdog.start()
 
+            # Encoder не переключается: rtsp_output добавляется к циркулярному
+            # буферу в start(), H.264 поток расходится по обоим выводам в процессе
             logger.info("RTSP стриминг запущен")
             return True
 
@@ -250,12 +700,98 @@ class CameraManager:
             logger.error(f"Ошибка запуска RTSP стриминга: {e}")
             return False
 
+    def _request_key_frame(self):
+        """Запросить у encoder внеочередной IDR кадр для нового вывода"""
+        request_key_frame = getattr(self.encoder, 'request_key_frame', None)
+        if request_key_frame is None:
+            # Старые версии picamera2: ближайший IDR придёт через iperiod кадров
+            logger.debug("Encoder не поддерживает request_key_frame")
+            return False
+
+        try:
+            request_key_frame()
+            return True
+        except Exception as e:
+            logger.warning(f"Ошибка запроса ключевого кадра: {e}")
+            return False
+
+    def _build_rtsp_url(self):
+        """Сформировать RTSP URL MediaMTX и его вариант с авторизацией"""
+        streaming_config = self.config.get('streaming', {})
+        rtsp_url = streaming_config.get('mediamtx_url', 'rtsp://localhost:8554/cam1')
+        username = streaming_config.get('username', 'admin')
+        password = streaming_config.get('password', 'changeme')
+
+        return rtsp_url, _inject_auth(rtsp_url, username, password)
+
+    def _spawn_rtsp_process(self):
+        """Запустить ffmpeg, публикующий H.264 из stdin в MediaMTX"""
+        # stderr ffmpeg читается только в режиме отладки и только в память
+        debug = self.config.get('streaming', {}).get('debug', False)
+
+        self.ffmpeg_process = subprocess.Popen(
+            self._rtsp_cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE if debug else subprocess.DEVNULL,
+            close_fds=False
+        )
+
+        # Увеличенный pipe поглощает кратковременные задержки отправки по RTSP
+        try:
+            fcntl.fcntl(self.ffmpeg_process.stdin.fileno(), F_SETPIPE_SZ, 1 << 20)
+        except OSError as e:
+            logger.debug(f"Не удалось увеличить pipe ffmpeg: {e}")
+
+        if debug:
+            threading.Thread(
+                target=self._read_ffmpeg_log,
+                args=(self.ffmpeg_process.stderr,),
+                daemon=True
+            ).start()
+
+        logger.info(f"FFmpeg процесс запущен (PID: {self.ffmpeg_process.pid})")
+
+    def _read_ffmpeg_log(self, stream):
+        """Читать stderr ffmpeg в кольцевой буфер последних строк"""
+        # ffmpeg печатает выходной URL целиком - пароль публикации скрывается,
+        # лог отдаётся через /api/rtsp/log
+        auth_url = self._rtsp_url_with_auth
+        for line in iter(stream.readline, b''):
+            text = line.decode(errors='replace').rstrip()
+            self.ffmpeg_log.append(text.replace(auth_url, self._rtsp_url))
+
+    def get_ffmpeg_log(self):
+        """Последние строки stderr RTSP ffmpeg (заполняется при streaming.debug)"""
+        return list(self.ffmpeg_log)
+
+    def _rtsp_watchdog_loop(self):
+        """Следить за ffmpeg и перезапускать его на месте, если процесс завершился"""
+        while not self._rtsp_watchdog_stop.wait(2.0):
+            if self.ffmpeg_process is None or self.ffmpeg_process.poll() is None:
+                continue
+
+            logger.warning(f"FFmpeg RTSP завершился (код {self.ffmpeg_process.returncode}), перезапуск")
+            try:
+                self.ffmpeg_process.stdin.close()
+            except Exception:
+                pass
+
+            try:
+                self._spawn_rtsp_process()
+                # Подменяем только pipe, encoder продолжает работу
+                self._rtsp_writer.set_pipe(self.ffmpeg_process.stdin)
+                # Новому ffmpeg нужен IDR, чтобы не ждать следующего GOP
+                self._request_key_frame()
+            except Exception as e:
+                logger.error(f"Ошибка перезапуска ffmpeg: {e}")
+
     def adjust_framerate(self, new_fps):
         """Динамическая настройка FPS (для thermal throttling)"""
         try:
             logger.info(f"Изменение FPS: {new_fps}")
-            controls = {"FrameRate": new_fps}
-            self.picam2.set_controls(controls)
+            self._fps_ctrl["FrameRate"] = new_fps
+            self.picam2.set_controls(self._fps_ctrl)
             return True
         except Exception as e:
             logger.error(f"Ошибка изменения FPS: {e}")
@@ -266,8 +802,8 @@ class CameraManager:
         if self.picam2:
             return {
                 "model": self.picam2.camera_properties.get('Model', 'Unknown'),
-                "resolution": self.config['camera']['main_resolution'],
-                "framerate": self.config['camera']['framerate'],
+                "resolution": self._main_res,
+                "framerate": self._framerate,
                 "is_recording": self.is_recording()
             }
         return None
@@ -280,12 +816,21 @@ class CameraManager:
             if self.is_recording():
                 self.stop_recording()
 
-            if self.encoder:
+            # Повторная остановка encoder/камеры бросает исключение в picamera2
+            if self._encoder_running:
                 self.picam2.stop_encoder()
+                self._encoder_running = False
+
+            if self._rtsp_watchdog:
+                self._rtsp_watchdog_stop.set()
+                self._rtsp_watchdog.join(timeout=5)
+                self._rtsp_watchdog = None
 
             if self.rtsp_output:
                 logger.info("Остановка RTSP стриминга")
                 self.rtsp_output = None
+                self._rtsp_writer.close()
+                self._rtsp_writer = None
 
             if self.ffmpeg_process:
                 logger.info("Остановка ffmpeg процесса")
@@ -301,9 +846,17 @@ class CameraManager:
                         pass
                 self.ffmpeg_process = None
 
-            if self.picam2:
+            if self.circular_output:
+                self.circular_output.close()
+                self.circular_output = None
+
+            if self._camera_running:
                 self.picam2.stop()
+                self._camera_running = False
+
+            if self.picam2:
                 self.picam2.close()
+                self.picam2 = None
 
             logger.info("Камера остановлена")
 
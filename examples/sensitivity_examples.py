@@ -5,15 +5,25 @@
 
 import requests
 import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 # Базовый URL веб-интерфейса RasCam
 BASE_URL = "http://localhost:5000"
 
+# Одна сессия на все запросы: TCP-соединение переиспользуется (keep-alive)
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(total=2, backoff_factor=0.1)
+))
+
 
 def get_current_sensitivity():
     """Получить текущую чувствительность"""
-    response = requests.get(f"{BASE_URL}/api/motion/sensitivity")
+    response = SESSION.get(f"{BASE_URL}/api/motion/sensitivity")
     data = response.json()
 
     print("Текущая чувствительность:")
@@ -29,7 +39,7 @@ def set_preset_sensitivity(level):
     Args:
         level: 'low', 'medium', 'high', 'very_high'
     """
-    response = requests.post(
+    response = SESSION.post(
         f"{BASE_URL}/api/motion/sensitivity",
         json={"sensitivity": level}
     )
@@ -51,7 +61,7 @@ def set_custom_threshold(threshold):
     Args:
         threshold: float от 0 до 50
     """
-    response = requests.post(
+    response = SESSION.post(
         f"{BASE_URL}/api/motion/threshold",
         json={"threshold": threshold}
     )
@@ -66,32 +76,90 @@ def set_custom_threshold(threshold):
     return data
 
 
-def get_full_status():
-    """Получить полный статус системы"""
-    response = requests.get(f"{BASE_URL}/api/status")
+def batch(ops):
+    """
+    Выполнить несколько операций одним HTTP-запросом (/api/batch)
+
+    Args:
+        ops: список {"method": ..., "path": ..., "body": ...}
+
+    Returns:
+        список тел ответов в том же порядке
+    """
+    response = SESSION.post(f"{BASE_URL}/api/batch", json=ops)
+    response.raise_for_status()
+    return [result['body'] for result in response.json()]
+
+
+def get_full_status(wait=False, since=None):
+    """
+    Получить полный статус системы
+
+    Args:
+        wait: long-poll - сервер ответит при изменении статуса (или через 30 сек)
+        since: версия статуса из предыдущего ответа
+    """
+    if wait:
+        params = {'wait': 30}
+        if since is not None:
+            params['since'] = since
+        response = SESSION.get(f"{BASE_URL}/api/status", params=params, timeout=35)
+    else:
+        response = SESSION.get(f"{BASE_URL}/api/status")
+    response.raise_for_status()
     data = response.json()
+    print_status(data)
+    return data
+
 
-    if 'motion' in data:
+def print_status(data):
+    """Вывести статус детектора движения"""
+    if data.get('motion'):
         print("\nСтатус детектора движения:")
         print(f"  Порог: {data['motion'].get('threshold')}")
         print(f"  Чувствительность: {data['motion'].get('sensitivity')}")
         print(f"  Зон детекции: {data['motion'].get('zones_count')}")
         print(f"  Активных зон: {data['motion'].get('zones_enabled')}")
 
-    return data
+
+def stream_events(duration=None):
+    """
+    Подписаться на SSE-поток /api/events и выдавать статусы по мере изменений
+
+    Args:
+        duration: прекратить через N секунд (None - бесконечно)
+    """
+    import time
+
+    deadline = time.time() + duration if duration else None
+    with SESSION.get(f"{BASE_URL}/api/events", stream=True, timeout=(5, 35)) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if deadline and time.time() >= deadline:
+                break
+            if line.startswith(b'data:'):
+                yield json.loads(line[5:])
 
 
 def example_scenario_indoor():
     """Пример сценария настройки для помещения"""
     print("\n=== Сценарий: Настройка для помещения ===")
 
-    # Начинаем со средней чувствительности
-    print("\n1. Устанавливаем среднюю чувствительность...")
-    set_preset_sensitivity('medium')
+    # Устанавливаем среднюю чувствительность и сразу проверяем результат -
+    # оба запроса уходят одним round-trip
+    print("\n1. Устанавливаем среднюю чувствительность и проверяем настройки...")
+    set_result, current = batch([
+        {"method": "POST", "path": "/api/motion/sensitivity", "body": {"sensitivity": "medium"}},
+        {"method": "GET", "path": "/api/motion/sensitivity"}
+    ])
 
-    # Проверяем результат
-    print("\n2. Проверяем настройки...")
-    get_current_sensitivity()
+    if set_result.get('success'):
+        print("Чувствительность установлена на 'medium'")
+    else:
+        print(f"Ошибка: {set_result.get('error')}")
+
+    print(f"  Уровень: {current['sensitivity']}")
+    print(f"  Порог: {current['threshold']}")
 
 
 def example_scenario_outdoor():
@@ -132,16 +200,20 @@ def example_gradual_adjustment():
     """Пример постепенной подстройки чувствительности"""
     print("\n=== Сценарий: Постепенная подстройка ===")
 
-    # Начинаем с текущего значения
+    # Начинаем с текущего значения (новый порог от него зависит, в batch не войдёт)
     current = get_current_sensitivity()
     current_threshold = current['threshold']
 
     print(f"\nТекущий порог: {current_threshold}")
 
-    # Увеличиваем на 2
+    # Увеличиваем на 2 и проверяем результат одним запросом
     new_threshold = current_threshold + 2.0
     print(f"\nУвеличиваем порог до {new_threshold} (понижаем чувствительность)...")
-    set_custom_threshold(new_threshold)
+    _, check = batch([
+        {"method": "POST", "path": "/api/motion/threshold", "body": {"threshold": new_threshold}},
+        {"method": "GET", "path": "/api/motion/sensitivity"}
+    ])
+    print(f"  Уровень: {check['sensitivity']}")
 
     input("\nПонаблюдайте за работой. Нажмите Enter для возврата...")
 
@@ -154,15 +226,11 @@ def example_monitoring():
     """Пример мониторинга состояния детектора"""
     print("\n=== Мониторинг детектора движения ===")
 
-    import time
-
-    print("\nМониторинг на 30 секунд (обновление каждые 5 сек)...")
-
-    for i in range(6):
-        status = get_full_status()
+    print("\nМониторинг на 30 секунд (сервер присылает статус при изменении)...")
 
-        if i < 5:
-            time.sleep(5)
+    # Одно постоянное соединение (SSE) вместо периодического опроса
+    for status in stream_events(duration=30):
+        print_status(status)
 
 
 if __name__ == "__main__":
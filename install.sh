@@ -91,10 +91,12 @@ echo "[5/8] Установка Python пакетов..."
 # Используем системные пакеты вместо pip (решает проблему externally-managed-environment)
 apt-get install -y \
     python3-flask \
-    python3-psutil
+    python3-psutil \
+    python3-orjson \
+    python3-waitress
 
-# Для пакета av используем pip с --break-system-packages (безопасно для этого пакета)
-pip3 install --break-system-packages av
+# Для пакетов av и Flask-Compress используем pip с --break-system-packages (безопасно для них)
+pip3 install --break-system-packages av Flask-Compress
 
 # Настройка gpu_mem
 echo "[6/8] Настройка GPU memory..."
@@ -149,8 +151,11 @@ Type=simple
 User=$REAL_USER
 WorkingDirectory=$INSTALL_DIR
 ExecStart=/usr/bin/python3 $INSTALL_DIR/surveillance.py
+ExecReload=/bin/kill -HUP \$MAINPID
 Restart=always
 RestartSec=10
+# SCHED_FIFO для потока захвата кадров
+AmbientCapabilities=CAP_SYS_NICE
 
 [Install]
 WantedBy=multi-user.target
@@ -79,7 +79,7 @@ sudo -u $REAL_USER python3 -m venv --system-site-packages venv
 # Активация venv и установка пакетов
 echo "[6/9] Установка Python пакетов в venv..."
 sudo -u $REAL_USER $INSTALL_DIR/venv/bin/pip install --upgrade pip
-sudo -u $REAL_USER $INSTALL_DIR/venv/bin/pip install Flask psutil av
+sudo -u $REAL_USER $INSTALL_DIR/venv/bin/pip install Flask psutil av orjson waitress Flask-Compress
 
 # Настройка gpu_mem
 echo "[7/9] Настройка GPU memory..."
@@ -126,8 +126,11 @@ Type=simple
 User=$REAL_USER
 WorkingDirectory=$INSTALL_DIR
 ExecStart=$INSTALL_DIR/venv/bin/python3 $INSTALL_DIR/surveillance.py
+ExecReload=/bin/kill -HUP \$MAINPID
 Restart=always
 RestartSec=10
+# SCHED_FIFO для потока захвата кадров
+AmbientCapabilities=CAP_SYS_NICE
 
 [Install]
 WantedBy=multi-user.target
@@ -4,44 +4,59 @@ Motion Detector с поддержкой зон детекции
 Использует MSE (Mean Squared Error) алгоритм на low-resolution потоке
 """
 
+import bisect
 import logging
+import threading
+import time
+import zlib
+import cv2
 import numpy as np
-from typing import List, Dict, Tuple
+from typing import List, Dict, NamedTuple, Tuple
 
 logger = logging.getLogger(__name__)
 
+# Предустановленные уровни чувствительности -> порог MSE
+SENSITIVITY_THRESHOLDS = {
+    'low': 15.0,        # Только крупные объекты
+    'medium': 7.0,      # Баланс между точностью и ложными срабатываниями
+    'high': 4.0,        # Чувствительный к мелким движениям
+    'very_high': 2.0    # Максимальная чувствительность
+}
+
+# Границы уровней (по возрастанию порога) для обратного поиска через bisect
+_LEVEL_BOUNDS = [4.0, 7.0, 15.0]
+_LEVEL_NAMES = ['very_high', 'high', 'medium', 'low']
+
 
 class DetectionZone:
     """Зона детекции движения"""
-    def __init__(self, name: str, x: int, y: int, width: int, height: int, enabled: bool = True):
+    def __init__(self, name: str, x: int, y: int, width: int, height: int, enabled: bool = True,
+                 decimation: int = 1):
         self.name = name
         self.x = x
         self.y = y
         self.width = width
         self.height = height
         self.enabled = enabled
-        self.prev_frame = None
-
-    def extract_region(self, frame: np.ndarray) -> np.ndarray:
-        """Извлечь регион из кадра"""
-        return frame[self.y:self.y + self.height, self.x:self.x + self.width]
 
-    def calculate_mse(self, current_region: np.ndarray) -> float:
-        """Вычислить MSE между текущим и предыдущим кадром"""
-        if self.prev_frame is None:
-            self.prev_frame = current_region.copy()
-            return 0.0
+        # Координаты в прореженном кадре (детектор работает на frame[::d, ::d])
+        self._x = x // decimation
+        self._y = y // decimation
+        self._w = max(1, -(-width // decimation))
+        self._h = max(1, -(-height // decimation))
+        self._slc = np.s_[self._y:self._y + self._h, self._x:self._x + self._w]
 
-        # Mean Squared Error
-        mse = np.square(np.subtract(current_region.astype(float),
-                                     self.prev_frame.astype(float))).mean()
+    def extract_region(self, frame: np.ndarray) -> np.ndarray:
+        """Извлечь регион из (прореженного) кадра"""
+        return frame[self._slc]
 
-        self.prev_frame = current_region.copy()
-        return mse
 
-    def reset(self):
-        """Сброс состояния зоны"""
-        self.prev_frame = None
+class _ZoneIndex(NamedTuple):
+    """Индекс активных зон: публикуется одним присваиванием, читается целиком"""
+    zones: Tuple['DetectionZone', ...]
+    bounds: Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]  # y0, y1, x0, x1
+    pixels: np.ndarray
+    single_full_frame: bool
 
 
 class MotionDetector:
@@ -52,15 +67,43 @@ class MotionDetector:
         self.threshold = config['motion_detection']['threshold']
         self.min_frames = config['motion_detection']['min_frames']
         self.lores_size = tuple(config['camera']['lores_resolution'])
+        # Форма Y-плоскости и число пикселей - для разбора сырого буфера без пересчёта
+        self._lores_shape = (self.lores_size[1], self.lores_size[0])
+        self._lores_pixels = self.lores_size[0] * self.lores_size[1]
+
+        # Прореживание кадра перед MSE: d=2 читает в 4 раза меньше пикселей,
+        # а MSE при равномерной выборке сохраняет масштаб (порог не меняется)
+        self.decimation = max(1, int(config['motion_detection'].get('decimation', 2)))
 
         # Счётчики для фильтрации ложных срабатываний
         self.motion_frame_count = 0
         self.no_motion_frame_count = 0
 
-        # Зоны детекции
+        # Зоны детекции (меняются из потоков веб-интерфейса - под замком)
         self.zones: List[DetectionZone] = []
+        self._zones_lock = threading.Lock()
         self._load_zones()
 
+        # Общие буферы прореженного кадра (одни на все зоны)
+        frame_h = -(-self.lores_size[1] // self.decimation)
+        frame_w = -(-self.lores_size[0] // self.decimation)
+        # Два непрерывных uint8 буфера: текущий и предыдущий кадр меняются местами
+        self._cur_frame = np.empty((frame_h, frame_w), dtype=np.uint8)
+        self._prev_frame = np.empty_like(self._cur_frame)
+        self._absdiff = np.empty_like(self._cur_frame)
+        self._integral_sum = np.empty((frame_h + 1, frame_w + 1), dtype=np.float64)
+        self._integral = np.empty((frame_h + 1, frame_w + 1), dtype=np.float64)
+        self._initialized = False
+        self._rebuild_zone_index()
+
+        # Дешёвый фильтр: хеш сетки пикселей с шагом _hash_step; если кадр не
+        # изменился, зоны не считаются. Раз в секунду полный проход выполняется
+        # всё равно, чтобы не пропустить медленное движение
+        self._hash_step = 4
+        self._last_hash = None
+        self._last_full_time = 0.0
+        self._full_pass_interval = 1.0
+
         logger.info(f"Motion detector инициализирован: threshold={self.threshold}, zones={len(self.zones)}")
 
     def _load_zones(self):
@@ -86,60 +129,173 @@ class MotionDetector:
                     y=zone_cfg['y'],
                     width=zone_cfg['width'],
                     height=zone_cfg['height'],
-                    enabled=zone_cfg.get('enabled', True)
+                    enabled=zone_cfg.get('enabled', True),
+                    decimation=self.decimation
                 )
                 self.zones.append(zone)
                 logger.info(f"Зона '{zone.name}': ({zone.x},{zone.y}) {zone.width}x{zone.height}")
 
-    def process_frame(self, frame_buffer) -> Tuple[bool, Dict]:
+    def _rebuild_zone_index(self):
+        """Пересобрать индекс активных зон (после изменения списка зон)
+
+        Поток детекции читает индекс без замка, поэтому он собирается целиком
+        и публикуется одним присваиванием: кадр видит либо старый, либо новый
+        набор зон, но не смесь из них.
+        """
+        # Зоны задаются прямоугольниками и суммируются по интегральному изображению,
+        # а не через карту меток + bincount: зоны могут пересекаться (например,
+        # full_frame и зона двери), а пиксель в карте меток принадлежит одной зоне
+        frame_h = -(-self.lores_size[1] // self.decimation)
+        frame_w = -(-self.lores_size[0] // self.decimation)
+
+        zones = tuple(z for z in self.zones if z.enabled)
+        y0 = np.array([min(z._y, frame_h) for z in zones], dtype=np.intp)
+        x0 = np.array([min(z._x, frame_w) for z in zones], dtype=np.intp)
+        y1 = np.array([min(z._y + z._h, frame_h) for z in zones], dtype=np.intp)
+        x1 = np.array([min(z._x + z._w, frame_w) for z in zones], dtype=np.intp)
+        pixels = np.maximum((y1 - y0) * (x1 - x0), 1)
+        for arr in (y0, y1, x0, x1, pixels):
+            arr.setflags(write=False)
+
+        # Частый случай (зона по умолчанию): одна зона на весь кадр -
+        # интегральное изображение не нужно, хватает одного cv2.norm
+        single_full_frame = len(zones) == 1 and int(pixels[0]) == frame_h * frame_w
+
+        self._zone_index = _ZoneIndex(zones, (y0, y1, x0, x1), pixels, single_full_frame)
+        self._last_hash = None
+
+    def _as_frame(self, frame_buffer) -> np.ndarray:
+        """Y-плоскость кадра как uint8 view (h, w) без копирования"""
+        if isinstance(frame_buffer, np.ndarray) and frame_buffer.ndim == 2:
+            # CameraManager уже отдаёт Y-плоскость
+            frame = frame_buffer
+        else:
+            # Преобразовать буфер в numpy array (берём только Y-канал из YUV420)
+            frame = np.frombuffer(frame_buffer, dtype=np.uint8, count=self._lores_pixels)
+            frame = frame.reshape(self._lores_shape)
+
+        if frame.dtype != np.uint8:
+            raise ValueError(f"Ожидается uint8 кадр, получен {frame.dtype}")
+        return frame
+
+    def update_reference(self, frame_buffer):
+        """
+        Запомнить кадр как опорный без детекции
+
+        Для кадров, пропущенных при прореживании детекции: следующий
+        process_frame сравнит кадр с соседним, а не с кадром N назад, и MSE
+        (а значит и порог) сохранит масштаб. Стоит одной прореженной копии.
+        """
+        try:
+            frame = self._as_frame(frame_buffer)
+            if self.decimation > 1:
+                frame = frame[::self.decimation, ::self.decimation]
+            if frame.shape != self._prev_frame.shape:
+                raise ValueError(f"Неожиданный размер кадра {frame.shape}")
+
+            np.copyto(self._prev_frame, frame)
+            self._initialized = True
+            # Опорный кадр сменился - совпадение хеша с последним посчитанным
+            # кадром больше не означает отсутствие разницы
+            self._last_hash = None
+        except Exception as e:
+            logger.error(f"Ошибка обновления опорного кадра: {e}")
+
+    def process_frame(self, frame_buffer, details_required: bool = False,
+                      stride: int = 1) -> Tuple[bool, Dict]:
         """
         Обработать кадр и определить наличие движения
 
         Args:
-            frame_buffer: YUV420 буфер из picamera2
+            frame_buffer: Y-плоскость (h, w) или YUV420 буфер из picamera2
+            details_required: собирать ли details по зонам (иначе возвращается {})
+            stride: детекция идёт на каждом stride-м кадре; серия min_frames
+                считается в тех же кадрах камеры, т.е. сокращается до
+                ceil(min_frames / stride) обработанных кадров
+
+        Кадр остаётся uint8 view на буфер камеры (без astype/копий) вплоть до
+        единственной копии прореженных пикселей в постоянный буфер _cur_frame.
 
         Returns:
             (motion_detected, details) где details содержит информацию о зонах
         """
         try:
-            # Преобразовать буфер в numpy array (берём только Y-канал из YUV420)
-            h, w = self.lores_size[1], self.lores_size[0]
-            frame = np.frombuffer(frame_buffer, dtype=np.uint8, count=w * h)
-            frame = frame.reshape((h, w))
+            frame = self._as_frame(frame_buffer)
+            # Один снимок индекса зон на весь кадр
+            zone_index = self._zone_index
+
+            step = self._hash_step
+            frame_hash = zlib.crc32(frame[::step, ::step].tobytes())
+            now = time.monotonic()
+            if frame_hash == self._last_hash and now - self._last_full_time < self._full_pass_interval:
+                # Кадр совпал с последним посчитанным: движения в нём нет, но и
+                # счётчики подряд идущих кадров не трогаем - пропущенный кадр
+                # не должен обнулять серию, набираемую до min_frames
+                if not details_required:
+                    return False, {}
+                return False, {
+                    zone.name: {'mse': 0.0, 'motion': False}
+                    for zone in zone_index.zones
+                }
 
-            motion_detected = False
-            zone_details = {}
+            if self.decimation > 1:
+                frame = frame[::self.decimation, ::self.decimation]
 
-            # Проверка каждой активной зоны
-            for zone in self.zones:
-                if not zone.enabled:
-                    continue
+            if frame.shape != self._cur_frame.shape:
+                raise ValueError(f"Неожиданный размер кадра {frame.shape}")
 
-                region = zone.extract_region(frame)
-                mse = zone.calculate_mse(region)
+            # Непрерывная копия кадра для OpenCV (заодно отвязывает нас от буфера камеры)
+            np.copyto(self._cur_frame, frame)
 
-                zone_motion = mse > self.threshold
-                zone_details[zone.name] = {
-                    'mse': round(mse, 2),
-                    'motion': zone_motion
+            # Один проход по всему кадру вместо цикла по зонам:
+            # |разность| -> интегральное изображение квадратов -> суммы по всем зонам сразу
+            if not self._initialized:
+                self._initialized = True
+                mse = np.zeros(len(zone_index.zones))
+            elif zone_index.single_full_frame:
+                sse = cv2.norm(self._cur_frame, self._prev_frame, cv2.NORM_L2SQR)
+                mse = np.array([sse / self._cur_frame.size])
+            else:
+                cv2.absdiff(self._cur_frame, self._prev_frame, dst=self._absdiff)
+                cv2.integral2(self._absdiff, self._integral_sum, self._integral,
+                              cv2.CV_64F, cv2.CV_64F)
+
+                y0, y1, x0, x1 = zone_index.bounds
+                sat = self._integral
+                sums = sat[y1, x1] - sat[y0, x1] - sat[y1, x0] + sat[y0, x0]
+                mse = sums / zone_index.pixels
+
+            self._cur_frame, self._prev_frame = self._prev_frame, self._cur_frame
+
+            zone_motion = mse > self.threshold
+            motion_detected = bool(zone_motion.any())
+
+            # Словарь по зонам нужен только для логов/веб-интерфейса -
+            # пути записи достаточно общего флага
+            zone_details = None
+            if details_required:
+                zone_details = {
+                    zone.name: {'mse': round(float(m), 2), 'motion': bool(z_motion)}
+                    for zone, m, z_motion in zip(zone_index.zones, mse, zone_motion)
                 }
 
-                if zone_motion:
-                    motion_detected = True
+            self._last_hash = frame_hash
+            self._last_full_time = now
 
             # Фильтрация: требуется N последовательных кадров с движением
             if motion_detected:
                 self.motion_frame_count += 1
                 self.no_motion_frame_count = 0
 
-                # Триггер только после min_frames подряд
-                should_trigger = self.motion_frame_count >= self.min_frames
+                # Триггер только после min_frames подряд (в кадрах камеры)
+                min_frames = -(-self.min_frames // stride) if stride > 1 else self.min_frames
+                should_trigger = self.motion_frame_count >= min_frames
             else:
                 self.motion_frame_count = 0
                 self.no_motion_frame_count += 1
                 should_trigger = False
 
-            return should_trigger, zone_details
+            return should_trigger, zone_details or {}
 
         except Exception as e:
             logger.error(f"Ошибка обработки кадра: {e}")
@@ -169,18 +325,11 @@ class MotionDetector:
         Args:
             sensitivity: 'low', 'medium', 'high', 'very_high'
         """
-        sensitivity_map = {
-            'low': 15.0,        # Только крупные объекты
-            'medium': 7.0,      # Баланс между точностью и ложными срабатываниями
-            'high': 4.0,        # Чувствительный к мелким движениям
-            'very_high': 2.0    # Максимальная чувствительность
-        }
-
-        if sensitivity not in sensitivity_map:
+        if sensitivity not in SENSITIVITY_THRESHOLDS:
             logger.error(f"Неизвестный уровень чувствительности: {sensitivity}")
             return False
 
-        new_threshold = sensitivity_map[sensitivity]
+        new_threshold = SENSITIVITY_THRESHOLDS[sensitivity]
         self.update_threshold(new_threshold)
         logger.info(f"Установлена чувствительность '{sensitivity}' (порог={new_threshold})")
         return True
@@ -192,22 +341,17 @@ class MotionDetector:
         Returns:
             Строковое представление уровня чувствительности
         """
-        if self.threshold >= 15.0:
-            return 'low'
-        elif self.threshold >= 7.0:
-            return 'medium'
-        elif self.threshold >= 4.0:
-            return 'high'
-        else:
-            return 'very_high'
+        return _LEVEL_NAMES[bisect.bisect_right(_LEVEL_BOUNDS, self.threshold)]
 
     def enable_zone(self, zone_name: str, enabled: bool = True):
         """Включить/выключить зону детекции"""
-        for zone in self.zones:
-            if zone.name == zone_name:
-                zone.enabled = enabled
-                logger.info(f"Зона '{zone_name}': {'включена' if enabled else 'выключена'}")
-                return True
+        with self._zones_lock:
+            for zone in self.zones:
+                if zone.name == zone_name:
+                    zone.enabled = enabled
+                    self._rebuild_zone_index()
+                    logger.info(f"Зона '{zone_name}': {'включена' if enabled else 'выключена'}")
+                    return True
         return False
 
     def add_zone(self, name: str, x: int, y: int, width: int, height: int):
@@ -217,20 +361,24 @@ class MotionDetector:
             logger.error(f"Зона '{name}' выходит за границы кадра")
             return False
 
-        zone = DetectionZone(name, x, y, width, height, enabled=True)
-        self.zones.append(zone)
+        zone = DetectionZone(name, x, y, width, height, enabled=True, decimation=self.decimation)
+        with self._zones_lock:
+            self.zones.append(zone)
+            self._rebuild_zone_index()
         logger.info(f"Добавлена зона '{name}': ({x},{y}) {width}x{height}")
         return True
 
     def remove_zone(self, zone_name: str):
         """Удалить зону детекции"""
-        self.zones = [z for z in self.zones if z.name != zone_name]
+        with self._zones_lock:
+            self.zones = [z for z in self.zones if z.name != zone_name]
+            self._rebuild_zone_index()
         logger.info(f"Зона '{zone_name}' удалена")
 
     def reset(self):
         """Сброс всех состояний детектора"""
         self.motion_frame_count = 0
         self.no_motion_frame_count = 0
-        for zone in self.zones:
-            zone.reset()
+        self._initialized = False
+        self._last_hash = None
         logger.info("Motion detector сброшен")
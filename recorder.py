@@ -5,9 +5,10 @@ Recording Manager - управление записями с автоматич
 
 import os
 import logging
+import threading
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional
 import time
 import subprocess
 
@@ -28,11 +29,15 @@ class RecordingManager:
 
         # Состояние записи
         self.is_recording = False
-        self.current_filename = None
+        self.current_filename: Optional[Path] = None
         self.recording_start_time = None
         self.last_motion_time = None
         self.frames_since_motion = 0
 
+        # Порог post-record в кадрах (пересчитывается только при смене FPS)
+        self._post_record_fps = None
+        self._post_record_frames = 0
+
         # Статистика
         self.stats = {
             'total_recordings': 0,
@@ -40,8 +45,54 @@ class RecordingManager:
             'last_cleanup': None
         }
 
+        # Кэш содержимого директории записей: {путь: os.stat_result},
+        # действителен, пока не изменились mtime/размер/число ссылок директории
+        # и не старше _scan_ttl: на FAT/exFAT (USB-накопители) mtime грубый, и
+        # два создания/удаления за один его тик ключ не меняют
+        self._dir_key = None
+        self._scan_time = 0.0
+        self._scan_ttl = 2.0
+        self._file_cache: Dict[str, os.stat_result] = {}
+
+        # TTL-кэш результата check_storage_space: (время, storage_info)
+        self._storage_cache = (0.0, {})
+        self._storage_cache_ttl = 5.0
+
+        # Счётчики, кэши и current_filename меняют главный цикл, поток cleanup
+        # и потоки веб-сервера - все изменения и весь проход cleanup под замком
+        self._lock = threading.Lock()
+
         self._ensure_storage_path()
 
+        # Суммарный размер записей ведётся инкрементально; полный обход - только при старте
+        files = self._scan()
+        self._total_bytes = sum(st.st_size for st in files.values())
+        self._recording_count = len(files)
+
+    def _scan(self) -> Dict[str, os.stat_result]:
+        """Снимок *.mp4 в директории записей (один проход os.scandir)"""
+        dir_stat = self.storage_path.stat()
+        dir_key = (dir_stat.st_mtime_ns, dir_stat.st_size, dir_stat.st_nlink)
+        now = time.monotonic()
+        if dir_key == self._dir_key and now - self._scan_time < self._scan_ttl:
+            return self._file_cache
+
+        files = {}
+        with os.scandir(self.storage_path) as it:
+            for entry in it:
+                if entry.name.endswith('.mp4') and entry.is_file():
+                    files[entry.path] = entry.stat()
+
+        self._file_cache = files
+        self._dir_key = dir_key
+        self._scan_time = now
+        return files
+
+    def _invalidate_cache(self):
+        """Сбросить кэш директории (размеры файлов изменились без смены mtime)"""
+        self._dir_key = None
+        self._storage_cache = (0.0, {})
+
     def _ensure_storage_path(self):
         """Создать директорию для хранения, если не существует"""
         try:
@@ -51,9 +102,10 @@ class RecordingManager:
             logger.error(f"Ошибка создания директории: {e}")
             raise
 
-    def generate_filename(self, event_type: str = "motion") -> str:
+    def generate_filename(self, event_type: str = "motion") -> Path:
         """Генерация имени файла с timestamp"""
-        timestamp = datetime.now().strftime("%m.%d_%H.%M")
+        # С секундами: две записи в одну минуту не перезаписывают друг друга
+        timestamp = datetime.now().strftime("%m.%d_%H.%M.%S")
 
         # Добавляем префикс для типа записи
         if self.continuous_recording:
@@ -62,8 +114,7 @@ class RecordingManager:
             prefix = "motion"  # Запись по движению
 
         filename = f"{prefix}_{timestamp}.mp4"
-        full_path = self.storage_path / filename
-        return str(full_path)
+        return self.storage_path / filename
 
     def should_start_recording(self, motion_detected: bool) -> bool:
         """Определить, нужно ли начинать запись"""
@@ -101,9 +152,11 @@ class RecordingManager:
             self.frames_since_motion = 0
         else:
             self.frames_since_motion += 1
-            frames_threshold = framerate * self.post_record_seconds
+            if framerate != self._post_record_fps:
+                self._post_record_fps = framerate
+                self._post_record_frames = framerate * self.post_record_seconds
 
-            if self.frames_since_motion >= frames_threshold:
+            if self.frames_since_motion >= self._post_record_frames:
                 logger.info(f"Нет движения {self.post_record_seconds}s, остановка записи")
                 return True
 
@@ -111,29 +164,44 @@ class RecordingManager:
 
     def start_recording(self) -> str:
         """Начать новую запись"""
-        self.current_filename = self.generate_filename("motion")
         self.recording_start_time = time.time()
         self.last_motion_time = time.time()
         self.frames_since_motion = 0
         self.is_recording = True
-        self.stats['total_recordings'] += 1
-
-        logger.info(f"Запись начата: {Path(self.current_filename).name}")
-        return self.current_filename
+        with self._lock:
+            self.current_filename = self.generate_filename("motion")
+            self.stats['total_recordings'] += 1
+            try:
+                # Файл с таким именем будет перезаписан: его размер уже учтён,
+                # а новая запись не добавляет файл в счётчик
+                self._total_bytes = max(0, self._total_bytes - self.current_filename.stat().st_size)
+            except FileNotFoundError:
+                self._recording_count += 1
+            self._invalidate_cache()
+
+        logger.info(f"Запись начата: {self.current_filename.name}")
+        return str(self.current_filename)
 
     def stop_recording(self):
         """Остановить текущую запись"""
-        if self.current_filename and os.path.exists(self.current_filename):
-            file_size = os.path.getsize(self.current_filename) / (1024 * 1024)
-            duration = time.time() - self.recording_start_time
-            self.stats['total_size_mb'] += file_size
-
-            logger.info(f"Запись остановлена: {Path(self.current_filename).name} "
-                       f"({duration:.1f}s, {file_size:.1f}MB)")
-
-        self.is_recording = False
-        self.current_filename = None
-        self.recording_start_time = None
+        with self._lock:
+            if self.current_filename:
+                try:
+                    file_bytes = self.current_filename.stat().st_size
+                    self._total_bytes += file_bytes
+                    file_size = file_bytes / (1024 * 1024)
+                    duration = time.time() - self.recording_start_time
+                    self.stats['total_size_mb'] += file_size
+
+                    logger.info(f"Запись остановлена: {self.current_filename.name} "
+                               f"({duration:.1f}s, {file_size:.1f}MB)")
+                except FileNotFoundError:
+                    pass
+
+            self.is_recording = False
+            self.current_filename = None
+            self.recording_start_time = None
+            self._invalidate_cache()
 
     def get_recordings_list(self) -> List[Dict]:
         """Получить список всех записей"""
@@ -141,15 +209,14 @@ class RecordingManager:
 
         try:
             # Получить все файлы и отсортировать по дате создания (новые первые)
-            files = list(self.storage_path.glob("*.mp4"))
-            files_sorted = sorted(files, key=lambda x: x.stat().st_ctime, reverse=True)
-
-            for file_path in files_sorted:
-                stat = file_path.stat()
+            with self._lock:
+                files = self._scan()
+            files_sorted = sorted(files.items(), key=lambda x: x[1].st_ctime, reverse=True)
 
+            for path, stat in files_sorted:
                 recordings.append({
-                    'filename': file_path.name,
-                    'path': str(file_path),
+                    'filename': os.path.basename(path),
+                    'path': path,
                     'size_mb': round(stat.st_size / (1024 * 1024), 2),
                     'created': datetime.fromtimestamp(stat.st_ctime),
                     'modified': datetime.fromtimestamp(stat.st_mtime)
@@ -162,20 +229,53 @@ class RecordingManager:
 
     def cleanup_old_recordings(self):
         """Удаление старых записей по retention policy"""
+        # Весь проход под замком: параллельный stop_recording не потеряет свой
+        # размер при пересчёте, а два cleanup не удаляют одни и те же файлы
+        with self._lock:
+            self._cleanup_locked()
+
+    def _cleanup_locked(self):
+        """Проход cleanup (вызывается под self._lock)"""
         try:
             cutoff_time = datetime.now() - timedelta(days=self.retention_days)
             deleted_count = 0
             freed_mb = 0
 
-            for file_path in self.storage_path.glob("*.mp4"):
-                file_time = datetime.fromtimestamp(file_path.stat().st_ctime)
-
-                if file_time < cutoff_time:
-                    file_size = file_path.stat().st_size / (1024 * 1024)
-                    file_path.unlink()
-                    deleted_count += 1
-                    freed_mb += file_size
-                    logger.info(f"Удалён старый файл: {file_path.name}")
+            # Свежий проход по директории (не из кэша): один stat на файл.
+            # Заодно пересчитываются счётчики размера/числа записей
+            current = str(self.current_filename) if self.current_filename else None
+            remaining_bytes = 0
+            remaining_count = 0
+
+            with os.scandir(self.storage_path) as it:
+                for entry in it:
+                    if not entry.name.endswith('.mp4'):
+                        continue
+
+                    try:
+                        stat = entry.stat()
+                        expired = (datetime.fromtimestamp(stat.st_ctime) < cutoff_time
+                                   and entry.path != current)
+                        if expired:
+                            os.unlink(entry.path)
+                    except FileNotFoundError:
+                        # Файл уже удалён (например, через веб-интерфейс) - пропустить
+                        continue
+
+                    if expired:
+                        deleted_count += 1
+                        freed_mb += stat.st_size / (1024 * 1024)
+                        logger.info(f"Удалён старый файл: {entry.name}")
+                        continue
+
+                    remaining_count += 1
+                    # Размер текущей записи учитывается в stop_recording
+                    if entry.path != current:
+                        remaining_bytes += stat.st_size
+
+            self._total_bytes = remaining_bytes
+            self._recording_count = remaining_count
+            self._invalidate_cache()
 
             if deleted_count > 0:
                 logger.info(f"Cleanup: удалено {deleted_count} файлов, освобождено {freed_mb:.1f}MB")
@@ -187,24 +287,29 @@ class RecordingManager:
 
     def check_storage_space(self) -> Dict:
         """Проверка доступного места"""
-        try:
-            # Общий размер всех записей
-            total_size = sum(f.stat().st_size for f in self.storage_path.glob("*.mp4"))
-            total_gb = total_size / (1024 ** 3)
+        now = time.monotonic()
+        cached_time, cached_info = self._storage_cache
+        if now - cached_time < self._storage_cache_ttl:
+            return cached_info
 
+        try:
             # Доступное место на диске
             stat_vfs = os.statvfs(self.storage_path)
             free_gb = (stat_vfs.f_bavail * stat_vfs.f_frsize) / (1024 ** 3)
 
-            usage_percent = (total_gb / self.max_storage_gb) * 100 if self.max_storage_gb > 0 else 0
+            with self._lock:
+                # Общий размер и число записей - счётчики, без обхода директории
+                total_gb = self._total_bytes / (1024 ** 3)
+                usage_percent = (total_gb / self.max_storage_gb) * 100 if self.max_storage_gb > 0 else 0
 
-            storage_info = {
-                'total_gb': round(total_gb, 2),
-                'free_gb': round(free_gb, 2),
-                'max_gb': self.max_storage_gb,
-                'usage_percent': round(usage_percent, 1),
-                'recordings_count': len(list(self.storage_path.glob("*.mp4")))
-            }
+                storage_info = {
+                    'total_gb': round(total_gb, 2),
+                    'free_gb': round(free_gb, 2),
+                    'max_gb': self.max_storage_gb,
+                    'usage_percent': round(usage_percent, 1),
+                    'recordings_count': self._recording_count
+                }
+                self._storage_cache = (now, storage_info)
 
             # Предупреждение при малом свободном месте
             if free_gb < 5:
@@ -225,11 +330,22 @@ class RecordingManager:
         """Удалить конкретную запись"""
         try:
             file_path = self.storage_path / filename
-            if file_path.exists() and file_path.suffix == '.mp4':
-                file_path.unlink()
-                logger.info(f"Запись удалена: {filename}")
-                return True
-            return False
+            if file_path.suffix != '.mp4':
+                return False
+
+            with self._lock:
+                try:
+                    file_bytes = file_path.stat().st_size
+                    file_path.unlink()
+                except FileNotFoundError:
+                    return False
+
+                self._total_bytes = max(0, self._total_bytes - file_bytes)
+                self._recording_count = max(0, self._recording_count - 1)
+                self._invalidate_cache()
+
+            logger.info(f"Запись удалена: {filename}")
+            return True
         except Exception as e:
             logger.error(f"Ошибка удаления записи {filename}: {e}")
             return False
@@ -240,7 +356,7 @@ class RecordingManager:
 
         return {
             'is_recording': self.is_recording,
-            'current_filename': Path(self.current_filename).name if self.current_filename else None,
+            'current_filename': self.current_filename.name if self.current_filename else None,
             'total_recordings': self.stats['total_recordings'],
             'storage': storage_info,
             'last_cleanup': self.stats['last_cleanup'],
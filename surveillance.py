@@ -6,12 +6,17 @@ RasCam - Система видеонаблюдения для Raspberry Pi 4 + C
 
 import json
 import logging
+import os
+import queue
 import signal
 import sys
 import time
 import threading
+from collections.abc import Mapping
+
+import numpy as np
 from pathlib import Path
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 from camera_manager import CameraManager
 from motion_detector import MotionDetector
@@ -19,6 +24,41 @@ from recorder import RecordingManager
 from thermal_monitor import ThermalMonitor
 
 
+class ConfigView(Mapping):
+    """
+    Живое представление конфигурации только для чтения (на всю глубину)
+
+    Вложенные секции оборачиваются при обращении, списки отдаются кортежами,
+    поэтому компонент не может изменить конфигурацию ни на каком уровне, а
+    правки веб-интерфейса в исходном dict видны сразу.
+    """
+
+    __slots__ = ('_data',)
+
+    def __init__(self, data: dict):
+        self._data = data
+
+    @staticmethod
+    def _wrap(value):
+        if isinstance(value, dict):
+            return ConfigView(value)
+        if isinstance(value, list):
+            return tuple(ConfigView._wrap(v) for v in value)
+        return value
+
+    def __getitem__(self, key):
+        return self._wrap(self._data[key])
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return f"ConfigView({self._data!r})"
+
+
 class SurveillanceSystem:
     """Главный класс системы видеонаблюдения"""
 
@@ -34,8 +74,19 @@ class SurveillanceSystem:
 
         # Состояние
         self.running = False
+        self._stopped = False
+        self._pipeline_threads = []
         self.original_fps = self.config['camera']['framerate']
 
+        # Версия статуса для long-poll веб-интерфейса: растёт при значимых
+        # изменениях (движение, запись, температура)
+        self.status_version = 0
+        self._status_cond = threading.Condition()
+
+        # Периодическая очистка старых записей (отдельный поток)
+        self.cleanup_interval = 300  # Cleanup каждые 5 минут
+        self._stop_event = threading.Event()
+
         # Регистрация обработчиков сигналов
         signal.signal(signal.SIGINT, self._signal_handler)
         signal.signal(signal.SIGTERM, self._signal_handler)
@@ -85,38 +136,62 @@ class SurveillanceSystem:
         console_handler = logging.StreamHandler()
         console_handler.setFormatter(formatter)
 
-        # Настройка root logger
+        # Root logger только кладёт записи в очередь; запись на диск/консоль
+        # (включая ротацию файлов) выполняет отдельный поток QueueListener
+        log_queue = queue.Queue(-1)
         root_logger = logging.getLogger()
         root_logger.setLevel(level)
-        root_logger.addHandler(file_handler)
-        root_logger.addHandler(console_handler)
+        root_logger.addHandler(QueueHandler(log_queue))
+
+        self._log_listener = QueueListener(log_queue, file_handler, console_handler,
+                                           respect_handler_level=True)
+        self._log_listener.start()
 
     def _signal_handler(self, signum, frame):
-        """Обработчик сигналов завершения"""
+        """Обработчик сигналов завершения: только просит главный цикл завершиться"""
         self.logger.info(f"Получен сигнал {signum}, завершение работы...")
-        self.stop()
+        self.running = False
+        self._stop_event.set()
 
     def initialize(self):
         """Инициализация всех компонентов"""
         try:
             self.logger.info("Инициализация компонентов...")
 
+            # Значения конфигурации, нужные в цикле и коллбэках
+            self._framerate = self.config['camera']['framerate']
+            self._throttle_fps = self.config['thermal']['throttle_reduce_fps']
+            self._storage_path = self.config['recording']['storage_path']
+
+            # Поток захвата: выделенное ядро и SCHED_FIFO (нужен CAP_SYS_NICE)
+            self._capture_cpu = self.config['camera'].get('capture_cpu', (os.cpu_count() or 1) - 1)
+            self._capture_rt_priority = self.config['camera'].get('capture_rt_priority', 10)
+
+            # Во время записи детектор запускается на каждом N-м кадре
+            self._detect_stride = max(1, int(
+                self.config['motion_detection'].get('detect_stride_while_recording', 3)))
+
+            # Компонентам - представление только для чтения на всю глубину:
+            # изменять конфигурацию (и сохранять её) может только веб-интерфейс
+            # через self.config
+            config_view = ConfigView(self.config)
+
             # Камера
             self.logger.info("Инициализация камеры...")
-            self.camera = CameraManager(self.config)
+            self.camera = CameraManager(config_view)
             self.camera.initialize()
 
             # Детектор движения
             self.logger.info("Инициализация детектора движения...")
-            self.motion_detector = MotionDetector(self.config)
+            self.motion_detector = MotionDetector(config_view)
 
             # Менеджер записи
             self.logger.info("Инициализация менеджера записи...")
-            self.recorder = RecordingManager(self.config)
+            self.recorder = RecordingManager(config_view)
 
             # Температурный монитор
             self.logger.info("Инициализация теплового монитора...")
-            self.thermal_monitor = ThermalMonitor(self.config)
+            self.thermal_monitor = ThermalMonitor(config_view)
 
             # Настройка коллбэков для thermal monitor
             self.thermal_monitor.set_callbacks(
@@ -136,27 +211,41 @@ class SurveillanceSystem:
             self.logger.error(f"Ошибка инициализации: {e}", exc_info=True)
             raise
 
+    def notify_status_change(self):
+        """Сообщить ожидающим клиентам, что статус изменился"""
+        with self._status_cond:
+            self.status_version += 1
+            self._status_cond.notify_all()
+
+    def wait_status_change(self, since: int, timeout: float) -> int:
+        """Дождаться версии статуса новее since (или таймаута), вернуть текущую"""
+        with self._status_cond:
+            self._status_cond.wait_for(lambda: self.status_version != since, timeout)
+            return self.status_version
+
     def _on_thermal_throttle(self, temp: float):
         """Реакция на повышенную температуру"""
-        reduced_fps = self.config['thermal']['throttle_reduce_fps']
-        self.logger.warning(f"Thermal throttle: снижение FPS до {reduced_fps}")
-        self.camera.adjust_framerate(reduced_fps)
+        self.logger.warning(f"Thermal throttle: снижение FPS до {self._throttle_fps}")
+        self.camera.adjust_framerate(self._throttle_fps)
+        self.notify_status_change()
 
     def _on_thermal_critical(self, temp: float):
         """Реакция на критическую температуру"""
         self.logger.critical(f"Критическая температура {temp}°C - минимальная нагрузка")
         # Снижаем FPS до минимума
         self.camera.adjust_framerate(5)
+        self.notify_status_change()
 
     def _on_thermal_normal(self, temp: float):
         """Восстановление после нормализации температуры"""
         self.logger.info("Температура нормализована, восстановление FPS")
         self.camera.adjust_framerate(self.original_fps)
+        self.notify_status_change()
 
     def _start_web_interface(self):
         """Запуск веб-интерфейса в отдельном потоке"""
         try:
-            from web_interface.app import run_web_server
+            from web_interface.app import clear_network_caches, run_web_server
 
             host = self.config['web_interface']['host']
             port = self.config['web_interface']['port']
@@ -171,6 +260,9 @@ class SurveillanceSystem:
             )
             self.web_thread.start()
 
+            # SIGHUP (systemctl reload) - заново определить IP для RTSP URL
+            signal.signal(signal.SIGHUP, lambda signum, frame: clear_network_caches())
+
         except Exception as e:
             self.logger.error(f"Ошибка запуска веб-интерфейса: {e}")
             self.logger.warning("Продолжение без веб-интерфейса")
@@ -187,103 +279,218 @@ class SurveillanceSystem:
             # Запуск теплового монитора
             self.thermal_monitor.start()
 
+            # Очистка старых записей по таймеру, вне цикла обработки кадров
+            threading.Thread(target=self._cleanup_loop, name="cleanup", daemon=True).start()
+
             # Запуск веб-интерфейса в отдельном потоке
             if self.config['web_interface']['enabled']:
                 self._start_web_interface()
 
             self.logger.info("Система запущена, начало мониторинга")
             self.logger.info(f"Разрешение: {self.config['camera']['main_resolution']}")
-            self.logger.info(f"FPS: {self.config['camera']['framerate']}")
-            self.logger.info(f"Хранилище: {self.config['recording']['storage_path']}")
+            self.logger.info(f"FPS: {self._framerate}")
+            self.logger.info(f"Хранилище: {self._storage_path}")
 
             # Главный цикл обработки
             self.main_loop()
 
         except KeyboardInterrupt:
             self.logger.info("Получен Ctrl+C, завершение...")
-            self.stop()
         except Exception as e:
             self.logger.error(f"Критическая ошибка: {e}", exc_info=True)
-            self.stop()
             sys.exit(1)
 
-    def main_loop(self):
-        """Главный цикл обработки кадров"""
-        frame_count = 0
-        cleanup_counter = 0
-        cleanup_interval = 300  # Cleanup каждые 5 минут (300 секунд * FPS)
+    def _cleanup_loop(self):
+        """Периодическая очистка старых записей (просыпается сразу при stop())"""
+        while not self._stop_event.wait(self.cleanup_interval):
+            try:
+                self.recorder.cleanup_old_recordings()
+            except Exception as e:
+                self.logger.error(f"Ошибка очистки записей: {e}", exc_info=True)
 
+    def _pin_current_thread(self, cpu, rt_priority=None):
+        """Привязать текущий поток к ядру и (опционально) выставить SCHED_FIFO"""
+        tid = threading.get_native_id()
+        try:
+            if cpu is not None:
+                os.sched_setaffinity(tid, {cpu})
+            if rt_priority:
+                os.sched_setscheduler(tid, os.SCHED_FIFO, os.sched_param(rt_priority))
+            self.logger.info(f"Поток {threading.current_thread().name}: CPU {cpu}, "
+                             f"SCHED_FIFO {rt_priority or '-'}")
+        except PermissionError:
+            self.logger.warning(f"Нет прав на SCHED_FIFO для потока "
+                                f"{threading.current_thread().name} (нужен CAP_SYS_NICE)")
+        except (OSError, AttributeError) as e:
+            self.logger.warning(f"Не удалось настроить планирование потока: {e}")
+
+    def _put_frame(self, q: queue.Queue, item) -> bool:
+        """Положить элемент в очередь конвейера (блокируется, пока система работает)"""
         while self.running:
             try:
-                # Захват low-res кадра для детекции
-                lores_frame, metadata = self.camera.get_lores_frame()
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _capture_worker(self):
+        """Стадия 1: захват lores кадров в свободный буфер из пула"""
+        self._pin_current_thread(self._capture_cpu, self._capture_rt_priority)
 
-                if lores_frame is None:
-                    time.sleep(0.01)
+        while self.running:
+            try:
+                try:
+                    idx = self._free_buffers.get(timeout=1.0)
+                except queue.Empty:
+                    continue
+
+                lores_frame, metadata = self.camera.get_lores_frame(out=self._lores_buffers[idx])
+                if lores_frame is None or not self._put_frame(self._capture_q, idx):
+                    self._free_buffers.put(idx)
+            except Exception as e:
+                self.logger.error(f"Ошибка захвата кадра: {e}", exc_info=True)
+                time.sleep(1)
+
+    def _detect_worker(self):
+        """Стадия 2: детекция движения"""
+        skip_counter = 0
+        last_result = (False, {})
+
+        while self.running:
+            try:
+                idx = self._capture_q.get(timeout=1.0)
+            except queue.Empty:
+                continue
+
+            # Пока идёт запись, полная детекция идёт на каждом N-м кадре.
+            # Промежуточные кадры лишь обновляют опорный кадр детектора (MSE
+            # считается между соседними кадрами, чувствительность та же) и
+            # повторяют последний результат, чтобы post-record таймер тикал
+            # в кадрах камеры; серия min_frames пересчитывается с учётом шага
+            stride = self._detect_stride if self.recorder.is_recording else 1
+            if stride > 1:
+                skip_counter = (skip_counter + 1) % stride
+                if skip_counter:
+                    try:
+                        self.motion_detector.update_reference(self._lores_buffers[idx])
+                    finally:
+                        self._free_buffers.put(idx)
+                    self._put_frame(self._detect_q, last_result)
+                    continue
+            else:
+                skip_counter = 0
+
+            try:
+                motion_detected, zone_details = self.motion_detector.process_frame(
+                    self._lores_buffers[idx],
+                    details_required=self.logger.isEnabledFor(logging.DEBUG),
+                    stride=stride
+                )
+            except Exception as e:
+                self.logger.error(f"Ошибка детекции: {e}", exc_info=True)
+                continue
+            finally:
+                # Детектор уже скопировал нужные пиксели - буфер можно отдавать захвату
+                self._free_buffers.put(idx)
+
+            last_result = (motion_detected, zone_details)
+            self._put_frame(self._detect_q, last_result)
+
+    def main_loop(self):
+        """
+        Главный цикл: стадия 3 конвейера (запись и обслуживание)
+
+        Захват и детекция работают в отдельных потоках и связаны с главным
+        циклом ограниченными очередями - заполненная очередь тормозит
+        предыдущую стадию, задержка не копится.
+        """
+        last_motion = False
+
+        # Двойная буферизация lores кадров: захват пишет в один буфер, пока
+        # детектор читает другой; индексы ходят по кругу через очередь свободных
+        lores_w, lores_h = self.config['camera']['lores_resolution']
+        self._lores_buffers = [np.empty((lores_h, lores_w), dtype=np.uint8) for _ in range(2)]
+        self._free_buffers = queue.Queue()
+        for idx in range(len(self._lores_buffers)):
+            self._free_buffers.put(idx)
+
+        self._capture_q = queue.Queue(maxsize=2)
+        self._detect_q = queue.Queue(maxsize=1)
+        self._pipeline_threads = [
+            threading.Thread(target=target, name=name, daemon=True)
+            for target, name in ((self._capture_worker, "capture"), (self._detect_worker, "detect"))
+        ]
+        for thread in self._pipeline_threads:
+            thread.start()
+
+        while self.running:
+            try:
+                try:
+                    motion_detected, zone_details = self._detect_q.get(timeout=1.0)
+                except queue.Empty:
                     continue
 
-                # Детекция движения
-                motion_detected, zone_details = self.motion_detector.process_frame(lores_frame)
+                # Логирование детекции (словарь зон форматируется только при DEBUG)
+                if motion_detected and self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug("Движение обнаружено: %s", zone_details)
 
-                # Логирование детекции
-                if motion_detected:
-                    self.logger.debug(f"Движение обнаружено: {zone_details}")
+                if motion_detected != last_motion:
+                    last_motion = motion_detected
+                    self.notify_status_change()
 
                 # Управление записью
                 if self.recorder.should_start_recording(motion_detected):
                     filename = self.recorder.start_recording()
                     self.camera.start_recording(filename)
+                    self.notify_status_change()
 
-                elif self.recorder.should_stop_recording(
-                    motion_detected,
-                    self.config['camera']['framerate']
-                ):
+                elif self.recorder.should_stop_recording(motion_detected, self._framerate):
                     self.camera.stop_recording()
                     self.recorder.stop_recording()
+                    self.notify_status_change()
 
                     # Проверка хранилища после остановки записи
                     storage_info = self.recorder.check_storage_space()
                     self.logger.info(f"Хранилище: {storage_info.get('usage_percent', 0)}% "
                                    f"({storage_info.get('recordings_count', 0)} файлов)")
 
-                # Периодическая очистка старых файлов
-                frame_count += 1
-                if frame_count % cleanup_interval == 0:
-                    self.recorder.cleanup_old_recordings()
-
-                # Небольшая задержка для снижения нагрузки CPU
-                time.sleep(0.01)
-
             except Exception as e:
                 self.logger.error(f"Ошибка в главном цикле: {e}", exc_info=True)
                 time.sleep(1)
 
     def stop(self):
-        """Остановка системы"""
-        if not self.running:
+        """Остановка системы (идемпотентна, процесс не завершает)"""
+        if self._stopped:
             return
+        self._stopped = True
 
         self.logger.info("Остановка системы...")
         self.running = False
+        self._stop_event.set()
+
+        # Дождаться стадий конвейера, чтобы они не обращались к камере при остановке
+        for thread in self._pipeline_threads:
+            thread.join(timeout=2)
 
         # Остановка компонентов
         if self.thermal_monitor:
             self.thermal_monitor.stop()
+            thermal_status = self.thermal_monitor.get_status()
+            self.logger.info(f"Средняя температура: {thermal_status.get('average_temp', 0)}°C")
 
         if self.camera:
+            # Камера сама дописывает и закрывает текущую запись
             self.camera.stop()
 
-        # Финальная статистика
         if self.recorder:
+            if self.recorder.is_recording:
+                self.recorder.stop_recording()
             stats = self.recorder.get_stats()
             self.logger.info(f"Всего записей: {stats.get('total_recordings', 0)}")
 
-        if self.thermal_monitor:
-            thermal_status = self.thermal_monitor.get_status()
-            self.logger.info(f"Средняя температура: {thermal_status.get('average_temp', 0)}°C")
-
         self.logger.info("Система остановлена")
-        sys.exit(0)
+        self._log_listener.stop()
 
     def get_status(self) -> dict:
         """Получить полный статус системы"""
@@ -310,8 +517,11 @@ def main():
 
     # Создание и запуск системы
     system = SurveillanceSystem()
-    system.initialize()
-    system.start()
+    try:
+        system.initialize()
+        system.start()
+    finally:
+        system.stop()
 
 
 if __name__ == "__main__":
@@ -38,6 +38,23 @@ try:
     motion, details = detector.process_frame(fake_frame)
     print(f"  ✓ Обработка кадра: motion={motion}")
 
+    # Прореживание детекции: сравнение с соседним кадром и серия min_frames / шаг
+    detector.reset()
+    base = np.full((240, 320), 100, dtype=np.uint8)
+    detector.process_frame(base)
+    detector.update_reference(base + 1)
+    _, d = detector.process_frame(base + 1, details_required=True, stride=3)
+    assert all(z['mse'] == 0.0 for z in d.values()), "MSE не к опорному кадру"
+    detector.reset()
+    detector.process_frame(base)
+    stride = 2
+    need = -(-detector.min_frames // stride)
+    hits = [detector.process_frame(base if i % 2 else base + 50, stride=stride)[0]
+            for i in range(need)]
+    assert hits[-1] and not any(hits[:-1]), f"Серия при шаге {stride}: {hits}"
+    detector.reset()
+    print(f"  ✓ Прореживание: опорный кадр и серия {need} кадр(а) при шаге {stride}")
+
     # Добавление зоны
     success = detector.add_zone("test_zone", 50, 50, 100, 100)
     print(f"  ✓ Добавление зоны: {success}")
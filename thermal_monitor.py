@@ -3,31 +3,112 @@
 Thermal Monitor - мониторинг температуры и автоматическое управление нагрузкой
 """
 
+import functools
 import logging
+import os
 import subprocess
 import threading
 import time
-from typing import Dict, Callable, Optional
+import numpy as np
+from dataclasses import dataclass, fields
+from types import MappingProxyType
+from typing import Dict, Callable, Mapping, Optional
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+# sysfs источники: чтение файла вместо запуска vcgencmd на каждый замер
+THERMAL_ZONE_PATH = '/sys/class/thermal/thermal_zone0/temp'
+THROTTLED_PATH = '/sys/devices/platform/soc/soc:firmware/get_throttled'
+
+# Биты get_throttled
+THROTTLE_FLAGS = (
+    ('undervoltage_now', 0x1),
+    ('freq_capped_now', 0x2),
+    ('throttled_now', 0x4),
+    ('soft_temp_limit', 0x8),
+    ('undervoltage_occurred', 0x10000),
+    ('freq_capped_occurred', 0x20000),
+    ('throttled_occurred', 0x40000),
+    ('soft_temp_limit_occurred', 0x80000),
+)
+
+
+@functools.lru_cache(maxsize=16)
+def _decode_throttled(throttled: int) -> Mapping:
+    """Разобрать маску get_throttled (значение почти всегда одно и то же - кэшируется)
+
+    Результат общий для всех вызовов, поэтому отдаётся только для чтения.
+    """
+    state = {name: bool(throttled & mask) for name, mask in THROTTLE_FLAGS}
+    state['raw'] = f'0x{throttled:x}'
+    return MappingProxyType(state)
+
+
+# Пустое состояние троттлинга (нет данных) - тоже общее и только для чтения
+_NO_THROTTLE_STATE = MappingProxyType({})
+
+
+@dataclass(frozen=True, slots=True)
+class ThermalSnapshot:
+    """Неизменяемый снимок состояния монитора (публикуется раз за цикл)
+
+    Вложенные throttle_state и thresholds - тоже Mapping только для чтения:
+    снимок один на всех читателей.
+    """
+    current_temp: float
+    average_temp: float
+    is_throttled: bool
+    throttle_state: Mapping
+    thresholds: Mapping
+    history_size: int
+
+    def as_mapping(self) -> Mapping:
+        """Поля снимка как Mapping только для чтения (без копирования вложенных)"""
+        return MappingProxyType({f.name: getattr(self, f.name) for f in fields(self)})
+
+    def to_dict(self) -> Dict:
+        """Независимая копия в обычных словарях"""
+        return {
+            name: dict(value) if isinstance(value, Mapping) else value
+            for name, value in self.as_mapping().items()
+        }
+
+
+@dataclass(frozen=True, slots=True)
+class ThermalConfig:
+    """Параметры монитора: атрибуты вместо цепочек config['thermal'][...]"""
+    check_interval: float
+    temp_warning: float
+    temp_throttle: float
+    temp_critical: float
+    throttle_reduce_fps: int
+    cpu_core: Optional[int] = 0
+
+    @classmethod
+    def from_config(cls, section: Mapping) -> 'ThermalConfig':
+        return cls(
+            check_interval=section['check_interval'],
+            temp_warning=section['temp_warning'],
+            temp_throttle=section['temp_throttle'],
+            temp_critical=section['temp_critical'],
+            throttle_reduce_fps=section['throttle_reduce_fps'],
+            # Ядро для потока мониторинга (дешёвый поток - не мешает захвату кадров)
+            cpu_core=section.get('cpu_core', 0)
+        )
+
 
 class ThermalMonitor:
     """Монитор температуры CPU с автоматическим управлением"""
 
-    def __init__(self, config: Dict):
+    def __init__(self, config: Mapping):
         self.config = config
-        self.check_interval = config['thermal']['check_interval']
-        self.temp_warning = config['thermal']['temp_warning']
-        self.temp_throttle = config['thermal']['temp_throttle']
-        self.temp_critical = config['thermal']['temp_critical']
-        self.throttle_reduce_fps = config['thermal']['throttle_reduce_fps']
+        self.cfg = ThermalConfig.from_config(config['thermal'])
 
         # Состояние
         self.current_temp = 0.0
         self.is_throttled = False
-        self.throttle_state = {}
+        self.throttle_state = _NO_THROTTLE_STATE
         self.running = False
         self.monitor_thread: Optional[threading.Thread] = None
 
@@ -37,27 +118,108 @@ class ThermalMonitor:
         self.on_critical: Optional[Callable] = None
         self.on_normal: Optional[Callable] = None
 
-        # История температур (последние 60 замеров)
-        self.temp_history = []
+        # История температур (последние 60 замеров): кольцевой буфер numpy
         self.max_history = 60
 
+        # Доступность sysfs (после первой неудачи - только vcgencmd)
+        self._sysfs_temp = True
+        self._sysfs_throttled = True
+        # (структура массивов: 12 байт на замер вместо словаря с datetime)
+        self._times = np.zeros(self.max_history, dtype=np.float64)
+        self._temps = np.zeros(self.max_history, dtype=np.float32)
+        self._idx = 0    # позиция следующей записи
+        self._count = 0  # число заполненных ячеек
+
+        # Снимок статуса: пересобирается монитором раз за цикл, читатели
+        # (веб-интерфейс) получают готовый объект без вычислений
+        self._thresholds = MappingProxyType({
+            'warning': self.cfg.temp_warning,
+            'throttle': self.cfg.temp_throttle,
+            'critical': self.cfg.temp_critical
+        })
+        self._publish_snapshot()
+
+    # Прежние атрибуты порогов - только чтение, значения берутся из self.cfg
+    @property
+    def check_interval(self) -> float:
+        return self.cfg.check_interval
+
+    @property
+    def temp_warning(self) -> float:
+        return self.cfg.temp_warning
+
+    @property
+    def temp_throttle(self) -> float:
+        return self.cfg.temp_throttle
+
+    @property
+    def temp_critical(self) -> float:
+        return self.cfg.temp_critical
+
+    @property
+    def throttle_reduce_fps(self) -> int:
+        return self.cfg.throttle_reduce_fps
+
+    @property
+    def cpu_core(self) -> Optional[int]:
+        return self.cfg.cpu_core
+
+    def _record_sample(self, temp: float):
+        """Записать замер в кольцевой буфер истории"""
+        self._times[self._idx] = time.time()
+        self._temps[self._idx] = temp
+        self._idx = (self._idx + 1) % self.max_history
+        self._count = min(self._count + 1, self.max_history)
+
+    def _publish_snapshot(self):
+        """Собрать и опубликовать снимок статуса (присваивание атомарно под GIL)"""
+        history_size = self._count
+        avg_temp = float(self._temps[:history_size].mean()) if history_size else 0.0
+
+        snapshot = ThermalSnapshot(
+            current_temp=round(self.current_temp, 1),
+            average_temp=round(avg_temp, 1),
+            is_throttled=self.is_throttled,
+            throttle_state=self.throttle_state,
+            thresholds=self._thresholds,
+            history_size=history_size
+        )
+        self._snapshot = snapshot
+        self._status = snapshot.as_mapping()
+
+    def _history(self):
+        """Замеры истории в хронологическом порядке: (times, temps)"""
+        if self._count < self.max_history:
+            return self._times[:self._count], self._temps[:self._count]
+
+        order = np.roll(np.arange(self.max_history), -self._idx)
+        return self._times[order], self._temps[order]
+
     def get_temperature(self) -> float:
         """Получить текущую температуру CPU"""
+        if self._sysfs_temp:
+            try:
+                with open(THERMAL_ZONE_PATH) as f:
+                    # Значение в миллиградусах
+                    return int(f.read()) / 1000.0
+            except (OSError, ValueError):
+                logger.info("sysfs температура недоступна, используется vcgencmd")
+                self._sysfs_temp = False
+
         try:
             result = subprocess.run(
                 ['vcgencmd', 'measure_temp'],
                 capture_output=True,
-                text=True,
                 timeout=5
             )
 
             if result.returncode == 0:
-                # Формат вывода: temp=62.3'C
-                temp_str = result.stdout.strip()
-                temp = float(temp_str.split('=')[1].split("'")[0])
-                return temp
+                # Формат вывода фиксирован: b"temp=62.3'C\n" - число между
+                # префиксом из 5 байт и апострофом, без декодирования и split
+                out = result.stdout
+                return float(out[5:out.index(b"'")])
             else:
-                logger.error(f"vcgencmd вернул ошибку: {result.stderr}")
+                logger.error(f"vcgencmd вернул ошибку: {result.stderr.decode(errors='replace')}")
                 return 0.0
 
         except FileNotFoundError:
@@ -68,45 +230,50 @@ class ThermalMonitor:
             logger.error(f"Ошибка получения температуры: {e}")
             return 0.0
 
-    def get_throttled_status(self) -> Dict:
-        """Проверить состояние троттлинга системы"""
-        try:
-            result = subprocess.run(
-                ['vcgencmd', 'get_throttled'],
-                capture_output=True,
-                text=True,
-                timeout=5
-            )
+    def get_throttled_status(self) -> Mapping:
+        """Проверить состояние троттлинга системы
 
-            if result.returncode == 0:
-                # Формат: throttled=0x0
-                throttled_hex = result.stdout.strip().split('=')[1]
-                throttled = int(throttled_hex, 16)
-
-                return {
-                    'undervoltage_now': bool(throttled & 0x1),
-                    'freq_capped_now': bool(throttled & 0x2),
-                    'throttled_now': bool(throttled & 0x4),
-                    'soft_temp_limit': bool(throttled & 0x8),
-                    'undervoltage_occurred': bool(throttled & 0x10000),
-                    'freq_capped_occurred': bool(throttled & 0x20000),
-                    'throttled_occurred': bool(throttled & 0x40000),
-                    'soft_temp_limit_occurred': bool(throttled & 0x80000),
-                    'raw': throttled_hex
-                }
-            return {}
+        Возвращается общий кэшированный Mapping только для чтения - без
+        словаря на каждый замер; в dict он превращается при сериализации.
+        """
+        try:
+            throttled_hex = None
+            if self._sysfs_throttled:
+                try:
+                    with open(THROTTLED_PATH) as f:
+                        # Формат sysfs: шестнадцатеричное число без префикса
+                        throttled_hex = f'0x{f.read().strip()}'
+                except OSError:
+                    logger.info("sysfs get_throttled недоступен, используется vcgencmd")
+                    self._sysfs_throttled = False
+
+            if throttled_hex is None:
+                result = subprocess.run(
+                    ['vcgencmd', 'get_throttled'],
+                    capture_output=True,
+                    text=True,
+                    timeout=5
+                )
+                if result.returncode == 0:
+                    # Формат: throttled=0x0
+                    throttled_hex = result.stdout.strip().split('=')[1]
+
+            if throttled_hex is not None:
+                return _decode_throttled(int(throttled_hex, 16))
+            return _NO_THROTTLE_STATE
 
         except Exception as e:
             logger.error(f"Ошибка получения throttled status: {e}")
-            return {}
+            return _NO_THROTTLE_STATE
 
     def analyze_temperature(self, temp: float) -> str:
         """Анализ температуры и определение действий"""
-        if temp >= self.temp_critical:
+        cfg = self.cfg
+        if temp >= cfg.temp_critical:
             return 'critical'
-        elif temp >= self.temp_throttle:
+        elif temp >= cfg.temp_throttle:
             return 'throttle'
-        elif temp >= self.temp_warning:
+        elif temp >= cfg.temp_warning:
             return 'warning'
         else:
             return 'normal'
@@ -128,7 +295,7 @@ class ThermalMonitor:
                     self.on_throttle(temp)
 
         elif state == 'warning':
-            logger.warning(f"Температура повышена: {temp}°C")
+            logger.warning("Температура повышена: %s°C", temp)
             if self.on_warning:
                 self.on_warning(temp)
 
@@ -141,7 +308,14 @@ class ThermalMonitor:
 
     def monitor_loop(self):
         """Основной цикл мониторинга"""
-        logger.info(f"Thermal monitor запущен (интервал: {self.check_interval}s)")
+        cfg = self.cfg
+        logger.info(f"Thermal monitor запущен (интервал: {cfg.check_interval}s)")
+
+        if cfg.cpu_core is not None:
+            try:
+                os.sched_setaffinity(threading.get_native_id(), {cfg.cpu_core})
+            except (OSError, AttributeError) as e:
+                logger.warning(f"Не удалось привязать thermal monitor к CPU {cfg.cpu_core}: {e}")
 
         while self.running:
             try:
@@ -149,12 +323,7 @@ class ThermalMonitor:
                 self.current_temp = self.get_temperature()
 
                 # Добавить в историю
-                self.temp_history.append({
-                    'timestamp': datetime.now(),
-                    'temp': self.current_temp
-                })
-                if len(self.temp_history) > self.max_history:
-                    self.temp_history.pop(0)
+                self._record_sample(self.current_temp)
 
                 # Получить состояние троттлинга
                 self.throttle_state = self.get_throttled_status()
@@ -164,18 +333,20 @@ class ThermalMonitor:
                     logger.error("⚡ НЕДОСТАТОЧНОЕ НАПРЯЖЕНИЕ! Проверьте блок питания")
 
                 if self.throttle_state.get('throttled_now'):
-                    logger.warning(f"⚠ Система в троттлинге (temp={self.current_temp}°C)")
+                    logger.warning("⚠ Система в троттлинге (temp=%s°C)", self.current_temp)
 
                 # Анализ и реакция на температуру
                 if self.current_temp > 0:
                     state = self.analyze_temperature(self.current_temp)
                     self.handle_thermal_state(state, self.current_temp)
 
+                self._publish_snapshot()
+
             except Exception as e:
                 logger.error(f"Ошибка в цикле мониторинга: {e}")
 
             # Ожидание следующей проверки
-            time.sleep(self.check_interval)
+            time.sleep(cfg.check_interval)
 
         logger.info("Thermal monitor остановлен")
 
@@ -197,38 +368,46 @@ class ThermalMonitor:
         if self.monitor_thread:
             self.monitor_thread.join(timeout=5)
 
-    def get_status(self) -> Dict:
-        """Получить текущий статус"""
-        avg_temp = 0.0
-        if self.temp_history:
-            avg_temp = sum(t['temp'] for t in self.temp_history) / len(self.temp_history)
+    def get_snapshot(self) -> ThermalSnapshot:
+        """Получить последний опубликованный снимок статуса"""
+        return self._snapshot
 
-        return {
-            'current_temp': round(self.current_temp, 1),
-            'average_temp': round(avg_temp, 1),
-            'is_throttled': self.is_throttled,
-            'throttle_state': self.throttle_state,
-            'thresholds': {
-                'warning': self.temp_warning,
-                'throttle': self.temp_throttle,
-                'critical': self.temp_critical
-            },
-            'history_size': len(self.temp_history)
-        }
+    def get_status(self) -> Mapping:
+        """Получить текущий статус (Mapping снимка только для чтения, собирается
+        раз за цикл мониторинга; в JSON превращается на стороне веб-интерфейса)"""
+        return self._status
+
+    def get_temperature_history(self, minutes: int = 10, max_points: Optional[int] = None) -> list:
+        """Получить историю температур за последние N минут
 
-    def get_temperature_history(self, minutes: int = 10) -> list:
-        """Получить историю температур за последние N минут"""
-        if not self.temp_history:
+        max_points - прореживание до заданного числа точек (равномерно по индексу,
+        последняя точка сохраняется всегда, первая - при max_points > 1)
+        до построения словарей.
+        """
+        if not self._count:
             return []
 
-        cutoff_time = datetime.now().timestamp() - (minutes * 60)
+        # Времена в хронологическом порядке отсортированы - граница бинарным поиском
+        times, temps = self._history()
+        start = int(np.searchsorted(times, time.time() - (minutes * 60)))
+        times, temps = times[start:], temps[start:]
+
+        # Прореживание - одна векторная выборка по индексам: цикл по точкам
+        # (и JIT для него) не нужен, работа целиком в C внутри numpy
+        if max_points and len(times) > max_points:
+            if max_points == 1:
+                # linspace из одной точки дал бы самый старый замер
+                idx = [len(times) - 1]
+            else:
+                idx = np.linspace(0, len(times) - 1, max_points, endpoint=True, dtype=np.intp)
+            times, temps = times[idx], temps[idx]
+
         return [
             {
-                'timestamp': t['timestamp'].isoformat(),
-                'temp': t['temp']
+                'timestamp': datetime.fromtimestamp(ts).isoformat(),
+                'temp': round(temp, 1)
             }
-            for t in self.temp_history
-            if t['timestamp'].timestamp() >= cutoff_time
+            for ts, temp in zip(times.tolist(), temps.tolist())
         ]
 
     def set_callbacks(self, on_warning=None, on_throttle=None, on_critical=None, on_normal=None):
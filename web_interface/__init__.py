@@ -0,0 +1,3 @@
+"""
+Веб-интерфейс RasCam (Flask): запускается из surveillance.py через run_web_server
+"""
@@ -3,28 +3,93 @@
 Flask веб-интерфейс для RasCam
 """
 
-import json
+import hashlib
 import logging
+import os
+import re
+import socket
 import sys
+import threading
+import time
 import zipfile
 import io
+from collections.abc import Mapping
 from pathlib import Path
 from datetime import datetime
-from functools import wraps
-from flask import Flask, render_template, jsonify, request, send_file, Response
-
-# Добавить родительскую директорию в путь для импорта модулей
-sys.path.insert(0, str(Path(__file__).parent.parent))
+from functools import lru_cache, wraps
+from urllib.parse import urlsplit
+import orjson
+from flask import Flask, render_template, request, send_file, Response, stream_with_context
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'rascam-secret-key-change-in-production'
 
+# Сжатие JSON (история температур, список записей) - если установлен flask-compress.
+# SSE (text/event-stream) и видео не сжимаются: только application/json от 1 КБ
+try:
+    from flask_compress import Compress
+except ImportError:
+    pass
+else:
+    app.config['COMPRESS_MIMETYPES'] = ['application/json']
+    app.config['COMPRESS_LEVEL'] = 1
+    app.config['COMPRESS_MIN_SIZE'] = 1024
+    Compress(app)
+
 # Глобальная ссылка на систему (будет установлена при запуске)
 surveillance_system = None
 
 # Logger
 logger = logging.getLogger(__name__)
 
+# Кэш сетевого IP для /api/rtsp (сокет и DNS не на каждый запрос)
+IP_CACHE_TTL = 60.0
+_ip_cache = {'ip': None, 'ts': 0.0}
+_ip_lock = threading.Lock()
+
+# Имена записей (без путей) и каталог хранилища (определяется при первом запросе)
+_MP4_NAME = re.compile(r'[\w\-.]+\.mp4')
+_storage_path = None
+
+# Не больше точек в /api/thermal/history (?points=N меняет предел)
+THERMAL_HISTORY_POINTS = 300
+
+# Сериализованный список записей для /api/recordings
+RECORDINGS_CACHE_TTL = 2.0
+# version растёт при каждом сбросе: список, собранный до сброса, не сохраняется
+_rec_cache = {'t': 0.0, 'data': None, 'version': 0}
+_rec_lock = threading.Lock()
+
+# Методы, разрешённые в операциях /api/batch
+BATCH_METHODS = frozenset({'GET', 'POST', 'DELETE'})
+
+# Поля тела POST /api/zones и их типы
+ZONE_FIELDS = (('name', str), ('x', int), ('y', int), ('width', int), ('height', int))
+
+# Сериализованный список зон для /api/zones и config.json; пересборка и
+# сброс под одним замком, иначе сброс посреди пересборки терялся
+_zones_cache = None
+_zones_dirty = True
+_zones_lock = threading.Lock()
+
+# JSON конфигурации для /api/config без паролей (None - пересобрать)
+_redacted_config = None
+
+# Сериализует запись config.json из параллельных запросов (общий tmp-файл)
+_config_lock = threading.Lock()
+
+# Готовые тела ошибок для @requires
+_NOT_INITIALIZED = {
+    component: orjson.dumps({'error': message})
+    for component, message in (
+        (None, 'System not initialized'),
+        ('recorder', 'Recorder not initialized'),
+        ('motion_detector', 'Motion detector not initialized'),
+        ('thermal_monitor', 'Thermal monitor not initialized'),
+        ('camera', 'Camera not initialized'),
+    )
+}
+
 # Basic Auth
 def check_auth(username, password):
     """Проверка логина/пароля"""
@@ -56,6 +121,41 @@ def requires_auth(f):
     return decorated
 
 
+def _orjson_default(obj):
+    """Типы, которых orjson не знает: неизменяемые Mapping компонентов -> dict"""
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    raise TypeError
+
+
+def _dumps(obj) -> bytes:
+    """Сериализация ответа: numpy и Mapping только для чтения - на границе JSON"""
+    return orjson.dumps(obj, default=_orjson_default, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+def _json(obj, status=200):
+    """JSON-ответ через orjson (datetime и numpy сериализуются без конвертации)"""
+    return Response(_dumps(obj), status=status, mimetype='application/json')
+
+
+def requires(component=None):
+    """Декоратор: ответить 500, пока система (или её компонент) не инициализирована
+
+    Тела ошибок сериализованы заранее - проверка сводится к одному условию.
+    """
+    error = _NOT_INITIALIZED[component]
+
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            system = surveillance_system
+            if system is None or (component and getattr(system, component, None) is None):
+                return Response(error, status=500, mimetype='application/json')
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+
 def set_surveillance_system(system):
     """Установить ссылку на систему наблюдения"""
     global surveillance_system
@@ -69,95 +169,175 @@ def index():
     return render_template('index.html')
 
 
+def _etag_matches(tag: str) -> bool:
+    """Есть ли tag (без кавычек) в If-None-Match запроса
+
+    Flask-Compress переписывает ETag сжатого ответа в "tag:gzip" (":br" и т.п.),
+    и браузер присылает его обратно в таком виде - суффикс алгоритма
+    отбрасывается, иначе 304 пропадает у ответов больше COMPRESS_MIN_SIZE.
+    """
+    return any(
+        candidate.split(':', 1)[0] == tag
+        for candidate in request.if_none_match.as_set(include_weak=True)
+    )
+
+
 @app.route('/api/status')
 @requires_auth
+@requires()
 def api_status():
     """API: получить статус системы"""
-    if surveillance_system is None:
-        return jsonify({'error': 'System not initialized'}), 500
-
     try:
+        # Long-poll: ?wait=N держит запрос до изменения статуса (не дольше N сек)
+        wait = min(request.args.get('wait', 0, type=float), 60.0)
+        if wait > 0:
+            since = request.args.get('since', surveillance_system.status_version, type=int)
+            surveillance_system.wait_status_change(since, wait)
+
         status = surveillance_system.get_status()
-        return jsonify(status)
+        status['version'] = surveillance_system.status_version
+        body = _dumps(status)
+
+        # Статус между опросами обычно не меняется: браузер переспрашивает
+        # с If-None-Match и получает пустой 304 вместо того же JSON
+        tag = hashlib.blake2b(body, digest_size=8).hexdigest()
+        headers = {'ETag': f'"{tag}"', 'Cache-Control': 'no-cache'}
+        if _etag_matches(tag):
+            return Response(status=304, headers=headers)
+        return Response(body, mimetype='application/json', headers=headers)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _json({'error': str(e)}, 500)
+
+
+@app.route('/api/events')
+@requires_auth
+@requires()
+def api_events():
+    """API: поток статуса (Server-Sent Events) - новое событие при каждом изменении"""
+    def generate():
+        version = None
+        while True:
+            if version is not None:
+                new_version = surveillance_system.wait_status_change(version, 15.0)
+                if new_version == version:
+                    # Комментарий-keepalive, чтобы прокси не закрыл соединение
+                    yield ": keepalive\n\n"
+                    continue
+
+            version = surveillance_system.status_version
+            status = surveillance_system.get_status()
+            status['version'] = version
+            yield b"data: " + _dumps(status) + b"\n\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 
 @app.route('/api/recordings')
+@requires('recorder')
 def api_recordings():
     """API: список записей"""
-    if surveillance_system is None or surveillance_system.recorder is None:
-        return jsonify({'error': 'Recorder not initialized'}), 500
-
     try:
-        recordings = surveillance_system.recorder.get_recordings_list()
-        # Конвертация datetime в строки для JSON
-        for rec in recordings:
-            rec['created'] = rec['created'].isoformat()
-            rec['modified'] = rec['modified'].isoformat()
-
-        return jsonify(recordings)
+        # Готовый JSON на RECORDINGS_CACHE_TTL: дашборд опрашивает список
+        # чаще, чем появляются новые записи
+        now = time.monotonic()
+        with _rec_lock:
+            data = _rec_cache['data']
+            version = _rec_cache['version']
+            if data is not None and now - _rec_cache['t'] > RECORDINGS_CACHE_TTL:
+                data = None
+
+        if data is None:
+            # datetime orjson сериализует сам (ISO 8601)
+            data = orjson.dumps(surveillance_system.recorder.get_recordings_list())
+            with _rec_lock:
+                # Пока список собирался, кэш могли сбросить (удаление записи)
+                if _rec_cache['version'] == version:
+                    _rec_cache['data'] = data
+                    _rec_cache['t'] = now
+        return Response(data, mimetype='application/json')
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _json({'error': str(e)}, 500)
+
+
+def _invalidate_recordings_cache():
+    """Сбросить кэш /api/recordings (после удаления записи)"""
+    with _rec_lock:
+        _rec_cache['data'] = None
+        _rec_cache['version'] += 1
+
+
+def _recording_path(filename):
+    """Путь к записи или None, если имя не похоже на файл записи
+
+    Регулярное выражение заодно не пропускает '/' и '..' за пределы хранилища.
+    """
+    global _storage_path
+    if not isinstance(filename, str) or not _MP4_NAME.fullmatch(filename):
+        return None
+    if _storage_path is None:
+        _storage_path = Path(surveillance_system.config['recording']['storage_path'])
+    return _storage_path / filename
 
 
 @app.route('/api/recording/<filename>')
+@requires('recorder')
 def api_get_recording(filename):
     """API: скачать/воспроизвести запись"""
-    if surveillance_system is None or surveillance_system.recorder is None:
-        return jsonify({'error': 'Recorder not initialized'}), 500
-
     try:
-        file_path = Path(surveillance_system.config['recording']['storage_path']) / filename
-
-        if not file_path.exists() or file_path.suffix != '.mp4':
-            return jsonify({'error': 'Recording not found'}), 404
+        file_path = _recording_path(filename)
+        if file_path is None:
+            return _json({'error': 'Recording not found'}, 404)
 
-        return send_file(file_path, mimetype='video/mp4')
+        # conditional: ответы 304/206 на If-None-Match и Range - перемотка
+        # в браузере догружает только нужный фрагмент вместо всего файла.
+        # Наличие файла проверяет единственный stat внутри send_file
+        try:
+            return send_file(file_path, mimetype='video/mp4', conditional=True, etag=True)
+        except FileNotFoundError:
+            return _json({'error': 'Recording not found'}, 404)
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _json({'error': str(e)}, 500)
 
 
 @app.route('/api/recording/<filename>', methods=['DELETE'])
+@requires('recorder')
 def api_delete_recording(filename):
     """API: удалить запись"""
-    if surveillance_system is None or surveillance_system.recorder is None:
-        return jsonify({'error': 'Recorder not initialized'}), 500
-
     try:
         success = surveillance_system.recorder.delete_recording(filename)
         if success:
-            return jsonify({'success': True})
+            _invalidate_recordings_cache()
+            return _json({'success': True})
         else:
-            return jsonify({'error': 'Failed to delete'}), 500
+            return _json({'error': 'Failed to delete'}, 500)
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _json({'error': str(e)}, 500)
 
 
 @app.route('/api/recordings/download', methods=['POST'])
+@requires('recorder')
 def api_download_multiple():
     """API: скачать несколько записей как ZIP"""
-    if surveillance_system is None or surveillance_system.recorder is None:
-        return jsonify({'error': 'Recorder not initialized'}), 500
-
     try:
         data = request.json
         filenames = data.get('filenames', [])
 
         if not filenames:
-            return jsonify({'error': 'No files specified'}), 400
-
-        storage_path = Path(surveillance_system.config['recording']['storage_path'])
+            return _json({'error': 'No files specified'}, 400)
 
         # Создать ZIP в памяти
         zip_buffer = io.BytesIO()
         with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
             for filename in filenames:
-                file_path = storage_path / filename
+                file_path = _recording_path(filename)
 
-                if not file_path.exists() or file_path.suffix != '.mp4':
+                if file_path is None or not file_path.exists():
                     continue
 
                 zip_file.write(file_path, filename)
@@ -173,133 +353,127 @@ def api_download_multiple():
 
     except Exception as e:
         logger.error(f"Ошибка создания ZIP: {e}")
-        return jsonify({'error': str(e)}), 500
+        return _json({'error': str(e)}, 500)
 
 
 @app.route('/api/thermal/history')
+@requires('thermal_monitor')
 def api_thermal_history():
     """API: история температур"""
-    if surveillance_system is None or surveillance_system.thermal_monitor is None:
-        return jsonify({'error': 'Thermal monitor not initialized'}), 500
-
     try:
         minutes = request.args.get('minutes', 10, type=int)
-        history = surveillance_system.thermal_monitor.get_temperature_history(minutes)
-        return jsonify(history)
+        points = request.args.get('points', THERMAL_HISTORY_POINTS, type=int)
+        if points < 1:
+            return _json({'error': 'points must be >= 1'}, 400)
+        history = surveillance_system.thermal_monitor.get_temperature_history(minutes, points)
+        return _json(history)
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _json({'error': str(e)}, 500)
 
 
 @app.route('/api/zones')
+@requires('motion_detector')
 def api_get_zones():
     """API: получить зоны детекции"""
-    if surveillance_system is None or surveillance_system.motion_detector is None:
-        return jsonify({'error': 'Motion detector not initialized'}), 500
-
     try:
-        zones = [
-            {
-                'name': zone.name,
-                'x': zone.x,
-                'y': zone.y,
-                'width': zone.width,
-                'height': zone.height,
-                'enabled': zone.enabled
-            }
-            for zone in surveillance_system.motion_detector.zones
-        ]
-        return jsonify(zones)
+        return _json(_zones_payload())
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _json({'error': str(e)}, 500)
+
+
+def _parse_zone_request(raw: bytes) -> dict:
+    """Разобрать и проверить тело POST /api/zones за один проход
+
+    Тело читается байтами и декодируется orjson; ошибки формата дают
+    ValueError с понятным сообщением (ответ 400), а не KeyError/TypeError (500).
+    """
+    try:
+        data = orjson.loads(raw)
+    except orjson.JSONDecodeError as e:
+        raise ValueError(f'Invalid JSON: {e}')
+    if not isinstance(data, dict):
+        raise ValueError('Expected JSON object')
+
+    zone = {}
+    for field, kind in ZONE_FIELDS:
+        value = data.get(field)
+        if kind is int and isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if type(value) is not kind:
+            raise ValueError(f"Field '{field}' must be {kind.__name__}")
+        zone[field] = value
+
+    if not zone['name'] or zone['width'] <= 0 or zone['height'] <= 0:
+        raise ValueError('Invalid zone parameters')
+    return zone
 
 
 @app.route('/api/zones', methods=['POST'])
+@requires('motion_detector')
 def api_add_zone():
     """API: добавить зону детекции"""
-    if surveillance_system is None or surveillance_system.motion_detector is None:
-        return jsonify({'error': 'Motion detector not initialized'}), 500
+    try:
+        zone = _parse_zone_request(request.get_data())
+    except ValueError as e:
+        return _json({'error': str(e)}, 400)
 
     try:
-        data = request.json
-        success = surveillance_system.motion_detector.add_zone(
-            name=data['name'],
-            x=data['x'],
-            y=data['y'],
-            width=data['width'],
-            height=data['height']
-        )
+        success = surveillance_system.motion_detector.add_zone(**zone)
 
         if success:
             # Сохранить в конфигурацию
+            _mark_zones_dirty()
             _save_zones_to_config()
-            return jsonify({'success': True})
+            return _json({'success': True})
         else:
-            return jsonify({'error': 'Invalid zone parameters'}), 400
+            return _json({'error': 'Invalid zone parameters'}, 400)
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _json({'error': str(e)}, 500)
 
 
 @app.route('/api/zones/<zone_name>', methods=['DELETE'])
-def api_delete_zone(zone_name):
-    """API: удалить зону детекции"""
-    if surveillance_system is None or surveillance_system.motion_detector is None:
-        return jsonify({'error': 'Motion detector not initialized'}), 500
-
-    try:
-        surveillance_system.motion_detector.remove_zone(zone_name)
-        _save_zones_to_config()
-        return jsonify({'success': True})
-
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
-
-
 @app.route('/api/zones/<zone_name>/toggle', methods=['POST'])
-def api_toggle_zone(zone_name):
-    """API: включить/выключить зону"""
-    if surveillance_system is None or surveillance_system.motion_detector is None:
-        return jsonify({'error': 'Motion detector not initialized'}), 500
-
+@requires('motion_detector')
+def api_zone_ops(zone_name):
+    """API: удалить зону (DELETE) или включить/выключить её (POST .../toggle)"""
     try:
-        data = request.json
-        enabled = data.get('enabled', True)
-        success = surveillance_system.motion_detector.enable_zone(zone_name, enabled)
-
-        if success:
-            _save_zones_to_config()
-            return jsonify({'success': True})
+        if request.method == 'DELETE':
+            surveillance_system.motion_detector.remove_zone(zone_name)
         else:
-            return jsonify({'error': 'Zone not found'}), 404
+            data = request.get_json(cache=True, silent=True) or {}
+            enabled = data.get('enabled', True)
+            if not surveillance_system.motion_detector.enable_zone(zone_name, enabled):
+                return _json({'error': 'Zone not found'}, 404)
+
+        _mark_zones_dirty()
+        _save_zones_to_config()
+        return _json({'success': True})
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _json({'error': str(e)}, 500)
 
 
 @app.route('/api/motion/sensitivity', methods=['GET'])
+@requires('motion_detector')
 def api_get_sensitivity():
     """API: получить текущую чувствительность"""
-    if surveillance_system is None or surveillance_system.motion_detector is None:
-        return jsonify({'error': 'Motion detector not initialized'}), 500
-
     try:
-        return jsonify({
+        return _json({
             'sensitivity': surveillance_system.motion_detector.get_sensitivity_level(),
             'threshold': surveillance_system.motion_detector.threshold
         })
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _json({'error': str(e)}, 500)
 
 
 @app.route('/api/motion/sensitivity', methods=['POST'])
+@requires('motion_detector')
 def api_set_sensitivity():
     """API: установить чувствительность"""
-    if surveillance_system is None or surveillance_system.motion_detector is None:
-        return jsonify({'error': 'Motion detector not initialized'}), 500
-
     try:
         data = request.json
         sensitivity = data.get('sensitivity')
@@ -309,124 +483,133 @@ def api_set_sensitivity():
             # Установить предустановленный уровень
             success = surveillance_system.motion_detector.set_sensitivity(sensitivity)
             if not success:
-                return jsonify({'error': 'Invalid sensitivity level'}), 400
+                return _json({'error': 'Invalid sensitivity level'}, 400)
         elif threshold is not None:
             # Установить точное значение порога
             surveillance_system.motion_detector.update_threshold(float(threshold))
         else:
-            return jsonify({'error': 'No sensitivity or threshold provided'}), 400
+            return _json({'error': 'No sensitivity or threshold provided'}, 400)
 
         # Сохранить в конфигурацию
         _save_motion_config()
 
-        return jsonify({
+        return _json({
             'success': True,
             'sensitivity': surveillance_system.motion_detector.get_sensitivity_level(),
             'threshold': surveillance_system.motion_detector.threshold
         })
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _json({'error': str(e)}, 500)
 
 
 @app.route('/api/motion/threshold', methods=['POST'])
+@requires('motion_detector')
 def api_set_threshold():
     """API: установить точный порог чувствительности"""
-    if surveillance_system is None or surveillance_system.motion_detector is None:
-        return jsonify({'error': 'Motion detector not initialized'}), 500
-
     try:
         data = request.json
         threshold = data.get('threshold')
 
         if threshold is None:
-            return jsonify({'error': 'Threshold value required'}), 400
+            return _json({'error': 'Threshold value required'}, 400)
 
         threshold = float(threshold)
         if threshold < 0 or threshold > 50:
-            return jsonify({'error': 'Threshold must be between 0 and 50'}), 400
+            return _json({'error': 'Threshold must be between 0 and 50'}, 400)
 
         surveillance_system.motion_detector.update_threshold(threshold)
         _save_motion_config()
 
-        return jsonify({
+        return _json({
             'success': True,
             'threshold': threshold,
             'sensitivity': surveillance_system.motion_detector.get_sensitivity_level()
         })
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _json({'error': str(e)}, 500)
 
 
 @app.route('/api/camera/rotation', methods=['GET'])
+@requires()
 def api_get_rotation():
     """API: получить текущую ориентацию"""
-    if surveillance_system is None:
-        return jsonify({'error': 'System not initialized'}), 500
-
     try:
-        return jsonify({
+        return _json({
             'rotation': surveillance_system.config['camera'].get('rotation', 0),
             'hflip': surveillance_system.config['camera'].get('hflip', False),
             'vflip': surveillance_system.config['camera'].get('vflip', False)
         })
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _json({'error': str(e)}, 500)
 
 
 @app.route('/api/camera/rotation', methods=['POST'])
+@requires()
 def api_set_rotation():
     """API: установить ориентацию (требует перезапуска)"""
-    if surveillance_system is None:
-        return jsonify({'error': 'System not initialized'}), 500
-
     try:
         data = request.json
         rotation = data.get('rotation')
 
         if rotation not in [0, 90, 180, 270]:
-            return jsonify({'error': 'Rotation must be 0, 90, 180, or 270'}), 400
+            return _json({'error': 'Rotation must be 0, 90, 180, or 270'}, 400)
 
         surveillance_system.config['camera']['rotation'] = rotation
 
         # Сохранить в конфигурацию
-        with open('config.json', 'w') as f:
-            json.dump(surveillance_system.config, f, indent=2)
+        _write_config()
 
         logger.info(f"Ориентация изменена на {rotation}° (требуется перезапуск)")
 
-        return jsonify({
+        return _json({
             'success': True,
             'rotation': rotation,
             'restart_required': True
         })
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _json({'error': str(e)}, 500)
+
+
+def _get_redacted_config() -> bytes:
+    """JSON конфигурации со скрытыми паролями (пересобирается после сохранения)
+
+    Глубокая копия через orjson: раньше copy() оставлял вложенные словари
+    общими, и '***' записывался в настоящий streaming.password.
+    """
+    global _redacted_config
+    data = _redacted_config
+    if data is None:
+        # Пересборка под тем же замком, что и запись config.json: кэш не
+        # соберётся посреди сохранения и не переживёт его сброс
+        with _config_lock:
+            if _redacted_config is None:
+                config_copy = orjson.loads(orjson.dumps(surveillance_system.config))
+                if 'streaming' in config_copy:
+                    config_copy['streaming']['password'] = '***'
+                auth = config_copy.get('web_interface', {}).get('auth')
+                if auth and 'password' in auth:
+                    auth['password'] = '***'
+                # Кэшируется уже сериализованный JSON - запрос отдаёт готовые байты
+                _redacted_config = orjson.dumps(config_copy)
+            data = _redacted_config
+    return data
 
 
 @app.route('/api/config')
+@requires()
 def api_get_config():
     """API: получить текущую конфигурацию"""
-    if surveillance_system is None:
-        return jsonify({'error': 'System not initialized'}), 500
-
-    # Скрыть пароли
-    config_copy = surveillance_system.config.copy()
-    if 'streaming' in config_copy:
-        config_copy['streaming']['password'] = '***'
-
-    return jsonify(config_copy)
+    return Response(_get_redacted_config(), mimetype='application/json')
 
 
 @app.route('/api/recording/continuous', methods=['POST'])
+@requires('recorder')
 def api_toggle_continuous_recording():
     """API: переключить режим непрерывной записи"""
-    if surveillance_system is None or surveillance_system.recorder is None:
-        return jsonify({'error': 'Recorder not initialized'}), 500
-
     try:
         data = request.json
         enabled = data.get('enabled', False)
@@ -436,80 +619,95 @@ def api_toggle_continuous_recording():
 
         # Сохранить в конфигурацию
         surveillance_system.config['recording']['continuous_recording'] = enabled
-        with open('config.json', 'w') as f:
-            json.dump(surveillance_system.config, f, indent=2)
+        _write_config()
 
         logger.info(f"Непрерывная запись: {'включена' if enabled else 'выключена'}")
 
-        return jsonify({'success': True, 'continuous_recording': enabled})
+        return _json({'success': True, 'continuous_recording': enabled})
 
     except Exception as e:
         logger.error(f"Ошибка переключения непрерывной записи: {e}")
-        return jsonify({'error': str(e)}), 500
+        return _json({'error': str(e)}, 500)
+
+
+def _resolve_local_ip() -> str:
+    """Определить сетевой IP системы (реальный, не localhost)"""
+    try:
+        # Создаём UDP соединение (не отправляем данные) чтобы узнать наш IP.
+        # Сокет каждый раз новый: у подключённого UDP-сокета Linux запоминает
+        # адрес источника при первом connect(), и долгоживущий сокет после
+        # смены адреса по DHCP продолжал бы возвращать старый IP
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("8.8.8.8", 80))
+            return s.getsockname()[0]
+    except Exception:
+        pass
+
+    # Fallback: пробуем получить IP через hostname
+    try:
+        return _hostname_ip()
+    except Exception:
+        return '0.0.0.0'
+
+
+@lru_cache(maxsize=1)
+def _hostname_ip() -> str:
+    """IP по имени хоста (резолвинг через nsswitch/DNS может блокировать - кэш
+    на время жизни процесса, сбрасывается clear_network_caches по SIGHUP)"""
+    hostname = socket.gethostname()
+    local_ip = socket.gethostbyname(hostname)
+    # Если получили localhost, пробуем найти другой интерфейс
+    if local_ip.startswith('127.'):
+        # Получаем все IP адреса
+        for addr in socket.getaddrinfo(hostname, None):
+            ip = addr[4][0]
+            if not ip.startswith('127.') and ':' not in ip:  # IPv4, не localhost
+                return ip
+    return local_ip
+
+
+def clear_network_caches():
+    """Забыть закэшированные IP (после смены адреса или имени хоста)"""
+    _hostname_ip.cache_clear()
+    with _ip_lock:
+        _ip_cache['ip'] = None
+
+
+@lru_cache(maxsize=4)
+def _parse_rtsp_base(base_url: str) -> tuple:
+    """Порт и путь из mediamtx_url (URL не меняется - разбирается один раз)"""
+    parts = urlsplit(base_url)
+    if not parts.netloc:
+        return '8554', '/cam1'
+    return str(parts.port or 8554), parts.path or '/cam1'
 
 
 @app.route('/api/rtsp')
+@requires()
 def api_get_rtsp():
     """API: получить RTSP URL для подключения"""
-    if surveillance_system is None:
-        return jsonify({'error': 'System not initialized'}), 500
-
     try:
         streaming_config = surveillance_system.config.get('streaming', {})
 
-        # Получить IP адрес системы (реальный сетевой IP, не localhost)
-        import socket
-        local_ip = '0.0.0.0'
-
-        try:
-            # Создаём UDP соединение (не отправляем данные) чтобы узнать наш IP
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            local_ip = s.getsockname()[0]
-            s.close()
-        except Exception:
-            # Fallback: пробуем получить IP через hostname
-            try:
-                local_ip = socket.gethostbyname(socket.gethostname())
-                # Если получили localhost, пробуем найти другой интерфейс
-                if local_ip.startswith('127.'):
-                    # Получаем все IP адреса
-                    hostname = socket.gethostname()
-                    addrs = socket.getaddrinfo(hostname, None)
-                    for addr in addrs:
-                        ip = addr[4][0]
-                        if not ip.startswith('127.') and ':' not in ip:  # IPv4, не localhost
-                            local_ip = ip
-                            break
-            except Exception:
-                local_ip = '0.0.0.0'
+        # IP адрес системы - из кэша, определяется заново раз в IP_CACHE_TTL
+        now = time.monotonic()
+        with _ip_lock:
+            if _ip_cache['ip'] is None or now - _ip_cache['ts'] > IP_CACHE_TTL:
+                _ip_cache['ip'] = _resolve_local_ip()
+                _ip_cache['ts'] = now
+            local_ip = _ip_cache['ip']
 
         # Сформировать RTSP URL
         username = streaming_config.get('username', 'admin')
         password = streaming_config.get('password', 'changeme')
         base_url = streaming_config.get('mediamtx_url', 'rtsp://localhost:8554/cam1')
 
-        # Извлечь порт и путь из base_url
-        if '://' in base_url:
-            protocol, rest = base_url.split('://', 1)
-            if '/' in rest:
-                host_port, path = rest.split('/', 1)
-                if ':' in host_port:
-                    _, port = host_port.split(':', 1)
-                else:
-                    port = '8554'
-                path = '/' + path
-            else:
-                port = '8554'
-                path = '/cam1'
-        else:
-            port = '8554'
-            path = '/cam1'
+        port, path = _parse_rtsp_base(base_url)
 
         # Сформировать полный URL с IP
         rtsp_url = f"rtsp://{username}:{password}@{local_ip}:{port}{path}"
 
-        return jsonify({
+        return _json({
             'rtsp_url': rtsp_url,
             'ip': local_ip,
             'port': port,
@@ -518,7 +716,141 @@ def api_get_rtsp():
         })
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _json({'error': str(e)}, 500)
+
+
+@app.route('/api/rtsp/log')
+@requires_auth
+@requires('camera')
+def api_get_rtsp_log():
+    """API: последние строки stderr ffmpeg RTSP (streaming.debug)"""
+    try:
+        return _json(surveillance_system.camera.get_ffmpeg_log())
+
+    except Exception as e:
+        return _json({'error': str(e)}, 500)
+
+
+@app.route('/api/batch', methods=['POST'])
+@requires_auth
+def api_batch():
+    """API: выполнить несколько запросов за один round-trip
+
+    Тело: [{"method": "POST", "path": "/api/...", "body": {...}}, ...]
+    Ответ: [{"status": 200, "body": {...}}, ...] в том же порядке
+    """
+    ops = request.get_json(silent=True)
+    if not isinstance(ops, list) or not ops:
+        return _json({'error': 'Expected non-empty list of operations'}, 400)
+    if len(ops) > 20:
+        return _json({'error': 'Too many operations (max 20)'}, 400)
+
+    results = []
+    headers = {}
+    if 'Authorization' in request.headers:
+        headers['Authorization'] = request.headers['Authorization']
+
+    for op in ops:
+        # Каждая операция проверяется отдельно: плохой элемент - 400 в своей
+        # ячейке ответа, остальные выполняются
+        error = _batch_op_error(op)
+        if error:
+            results.append({'status': 400, 'body': {'error': error}})
+            continue
+
+        # Внутренний вызов маршрута без нового HTTP-соединения
+        try:
+            with app.test_request_context(op['path'], method=op.get('method', 'GET').upper(),
+                                          json=op.get('body'), headers=headers):
+                response = app.full_dispatch_request()
+        except Exception as e:
+            logger.error(f"Ошибка пакетной операции {op['path']}: {e}")
+            results.append({'status': 500, 'body': {'error': 'Internal error'}})
+            continue
+
+        results.append({
+            'status': response.status_code,
+            'body': response.get_json(silent=True)
+        })
+
+    return _json(results)
+
+
+def _batch_op_error(op):
+    """Текст ошибки для некорректной операции /api/batch или None"""
+    if not isinstance(op, dict):
+        return 'Operation must be an object'
+    path = op.get('path')
+    if not isinstance(path, str) or not path.startswith('/api/') or path.startswith('/api/batch'):
+        return f'Invalid path: {path}'
+    method = op.get('method', 'GET')
+    if not isinstance(method, str) or method.upper() not in BATCH_METHODS:
+        return f'Invalid method: {method}'
+    return None
+
+
+def _write_config():
+    """Атомарно записать конфигурацию в config.json
+
+    Сериализация в байты заранее, одна запись во временный файл, fsync и
+    os.replace: ни сбой посреди записи, ни пропадание питания сразу после
+    переименования не оставят config.json обрезанным или пустым.
+    """
+    global _redacted_config
+
+    data = orjson.dumps(surveillance_system.config, option=orjson.OPT_INDENT_2)
+    # tmp рядом с config.json (в той же директории, что и fsync ниже), а не в CWD
+    cfg_path = os.path.abspath('config.json')
+    cfg_dir = os.path.dirname(cfg_path)
+    tmp = os.path.join(cfg_dir, 'config.json.tmp')
+    with _config_lock:
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            # Данные на диске до rename - иначе rename может пережить сбой без них
+            os.fsync(f.fileno())
+        os.replace(tmp, cfg_path)
+        # Кэш /api/config сбрасывается под замком, уже после сохранения
+        _redacted_config = None
+
+        # Сама запись о переименовании - в директории
+        try:
+            dir_fd = os.open(cfg_dir, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(dir_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(dir_fd)
+
+
+def _zones_payload():
+    """Зоны в виде списка словарей (пересобирается только после изменения зон)"""
+    global _zones_cache, _zones_dirty
+    with _zones_lock:
+        if _zones_dirty or _zones_cache is None:
+            _zones_cache = [
+                {
+                    'name': zone.name,
+                    'x': zone.x,
+                    'y': zone.y,
+                    'width': zone.width,
+                    'height': zone.height,
+                    'enabled': zone.enabled
+                }
+                for zone in surveillance_system.motion_detector.zones
+            ]
+            _zones_dirty = False
+        return _zones_cache
+
+
+def _mark_zones_dirty():
+    """Сбросить кэш зон (после add/remove/toggle)"""
+    global _zones_dirty
+    with _zones_lock:
+        _zones_dirty = True
 
 
 def _save_zones_to_config():
@@ -526,23 +858,13 @@ def _save_zones_to_config():
     if surveillance_system is None:
         return
 
-    zones_data = [
-        {
-            'name': zone.name,
-            'x': zone.x,
-            'y': zone.y,
-            'width': zone.width,
-            'height': zone.height,
-            'enabled': zone.enabled
-        }
-        for zone in surveillance_system.motion_detector.zones
+    # Копия: правка config на месте не должна менять кэш мимо флага
+    surveillance_system.config['motion_detection']['zones'] = [
+        dict(zone) for zone in _zones_payload()
     ]
 
-    surveillance_system.config['motion_detection']['zones'] = zones_data
-
     # Сохранить в файл
-    with open('config.json', 'w') as f:
-        json.dump(surveillance_system.config, f, indent=2)
+    _write_config()
 
 
 def _save_motion_config():
@@ -553,13 +875,26 @@ def _save_motion_config():
     surveillance_system.config['motion_detection']['threshold'] = surveillance_system.motion_detector.threshold
 
     # Сохранить в файл
-    with open('config.json', 'w') as f:
-        json.dump(surveillance_system.config, f, indent=2)
+    _write_config()
 
 
 def run_web_server(system, host='0.0.0.0', port=5000, debug=False):
-    """Запустить веб-сервер"""
+    """Запустить веб-сервер (waitress, если установлен; встроенный - в debug)"""
     set_surveillance_system(system)
+
+    if not debug:
+        try:
+            from waitress import serve
+        except ImportError:
+            logger.warning("waitress не установлен, используется встроенный сервер Flask")
+        else:
+            # Пул потоков общий: SSE и long-poll держат поток на всё время
+            # ожидания, а скачивание записи - на время передачи. 16 потоков
+            # хватает, чтобы несколько клиентов не блокировали опрос /api
+            serve(app, host=host, port=port, threads=16,
+                  connection_limit=200, channel_timeout=120)
+            return
+
     app.run(host=host, port=port, debug=debug, threaded=True)
 
 